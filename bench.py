@@ -0,0 +1,850 @@
+"""Local benchmarks for the writing pad relay.
+
+Each benchmark is a subcommand; run ``python bench.py <name> --help`` for
+its options. Benchmarks that need a server start their own copy of
+server.py on a free port.
+"""
+import argparse
+import base64
+import http.cookiejar
+import json
+import math
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, **env):
+    """Start server.py on ``port`` and wait until it accepts connections.
+
+    Unless ``PAD_DATA_DIR`` is given the server gets an empty temporary
+    data directory, removed by ``stop_server``, so benchmark strokes never
+    reach the real write-ahead log.
+    """
+    scratch = None
+    if "PAD_DATA_DIR" not in env:
+        scratch = env["PAD_DATA_DIR"] = tempfile.mkdtemp(prefix="pad-bench-")
+    full_env = dict(os.environ, PAD_PORT=str(port), **env)
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py")], env=full_env)
+    proc.scratch_dir = scratch
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    stop_server(proc)
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    if proc.scratch_dir is not None:
+        shutil.rmtree(proc.scratch_dir, ignore_errors=True)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def peak_rss(pid):
+    """Peak resident set size of ``pid`` in bytes (Linux only)."""
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def login(base_url, username="bench", password="bench"):
+    """Return a urllib opener holding a session cookie for a fresh user."""
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    form = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    opener.open(base_url + "/signup", form).read()
+    return opener
+
+
+def post(opener, url, body, content_type, method="POST", headers=None):
+    req = urllib.request.Request(url, data=body, method=method,
+                                 headers=dict(headers or {}, **{"Content-Type": content_type}))
+    with opener.open(req) as res:
+        return json.loads(res.read())
+
+
+def synthetic_png(size, width=1920, height=1080):
+    """A structurally valid PNG of roughly ``size`` bytes."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr)
+            + chunk(b"IDAT", os.urandom(max(0, size - 57))) + chunk(b"IEND", b""))
+
+
+def sample_stroke(segments, start=0.1):
+    """A wavy left-to-right stroke of ``segments`` draw events."""
+    points = [(start + 0.8 * i / segments, 0.5 + 0.3 * math.sin(i / 10)) for i in range(segments + 1)]
+    return [
+        {"lastX": round(x0, 4), "lastY": round(y0, 4), "x": round(x1, 4), "y": round(y1, 4),
+         "erasing": False, "color": "black"}
+        for (x0, y0), (x1, y1) in zip(points, points[1:])
+    ]
+
+
+class ByteCounterProxy:
+    """TCP proxy that counts the bytes flowing through it in each direction.
+
+    ``deflate`` is set once a WebSocket upgrade response accepts
+    permessage-deflate.
+    """
+
+    def __init__(self, target_port):
+        self.target_port = target_port
+        self.sent = 0
+        self.received = 0
+        self.deflate = False
+        self.lock = threading.Lock()
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            threading.Thread(target=self.pipe, args=(client, upstream, "sent"), daemon=True).start()
+            threading.Thread(target=self.pipe, args=(upstream, client, "received"), daemon=True).start()
+
+    def pipe(self, src, dst, counter):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                with self.lock:
+                    setattr(self, counter, getattr(self, counter) + len(data))
+                if counter == "received" and data.startswith(b"HTTP/1.1 101"):
+                    self.deflate = self.deflate or b"permessage-deflate" in data.lower()
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for s in (src, dst):
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def reset(self):
+        with self.lock:
+            self.sent = self.received = 0
+
+    def close(self):
+        self.listener.close()
+
+
+def bench_transport(args):
+    import socketio
+
+    from server import transport_profiles
+
+    stroke = sample_stroke(args.segments)
+    # The python-socketio client's WebSocket library does not offer
+    # permessage-deflate, so WebSocket bytes here are uncompressed; browsers
+    # would negotiate it.
+    print("%-10s %12s %12s %14s %14s %10s" % ("profile", "bytes up", "bytes down", "first stroke", "all strokes",
+                                             "ws deflate"))
+    for name in args.profiles or transport_profiles:
+        transports = transport_profiles[name]["client"].get("transports", ["polling", "websocket"])
+        port = free_port()
+        # The burst is far over the default draw limit; measure the transport, not the limiter.
+        server = start_server(port, PAD_TRANSPORT=name, PAD_DRAW_RATE="0")
+        proxy = ByteCounterProxy(port)
+        url = "http://127.0.0.1:%d" % proxy.port
+        try:
+            first = threading.Event()
+            done = threading.Event()
+            count = [0]
+            receiver = socketio.Client()
+
+            @receiver.on("draw")
+            def on_draw(data):
+                count[0] += 1
+                first.set()
+                if count[0] == len(stroke):
+                    done.set()
+
+            sender = socketio.Client()
+            started = time.perf_counter()
+            receiver.connect(url, transports=transports)
+            sender.connect(url, transports=transports)
+            for segment in stroke:
+                sender.emit("draw", segment)
+            first.wait(30)
+            first_at = time.perf_counter() - started
+            done.wait(60)
+            done_at = time.perf_counter() - started
+            sender.disconnect()
+            receiver.disconnect()
+            print("%-10s %12d %12d %12.1fms %12.1fms %10s" % (
+                name, proxy.sent, proxy.received, first_at * 1000, done_at * 1000,
+                "yes" if proxy.deflate else "no"))
+        finally:
+            proxy.close()
+            stop_server(server)
+
+
+def save_once(opener, base_url, mode, body):
+    if mode == "json":
+        data = "data:image/png;base64," + base64.b64encode(body).decode()
+        return post(opener, base_url + "/save", json.dumps({"data": data}).encode(), "application/json")
+    if mode == "stream":
+        return post(opener, base_url + "/save", body, "image/png")
+    upload_id = post(opener, base_url + "/upload", b"", "application/json")["upload_id"]
+    chunk = 256 * 1024
+    for offset in range(0, len(body), chunk):
+        post(opener, base_url + "/upload/" + upload_id, body[offset:offset + chunk],
+             "application/octet-stream", method="PATCH", headers={"Upload-Offset": str(offset)})
+    return post(opener, base_url + "/upload/%s/finish" % upload_id, b"", "image/png")
+
+
+def bench_save(args):
+    body = synthetic_png(args.size)
+    print("%-10s %12s %12s %12s" % ("mode", "peak RSS", "p50", "p99"))
+    for mode in args.modes:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as data_dir:
+            server = start_server(port, PAD_DATA_DIR=data_dir)
+            base_url = "http://127.0.0.1:%d" % port
+            try:
+                opener = login(base_url)
+                baseline = peak_rss(server.pid)
+
+                def timed(_):
+                    started = time.perf_counter()
+                    result = save_once(opener, base_url, mode, body)
+                    assert "page_id" in result, result
+                    return time.perf_counter() - started
+
+                with ThreadPoolExecutor(args.concurrency) as pool:
+                    latencies = list(pool.map(timed, range(args.requests)))
+                print("%-10s %10.1fMB %10.0fms %10.0fms" % (
+                    mode, (peak_rss(server.pid) - baseline) / 2 ** 20,
+                    percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+            finally:
+                stop_server(server)
+
+
+def bench_pages(args):
+    import server
+    from pages import PageIndex
+
+    index = PageIndex()
+    started = time.perf_counter()
+    for i in range(args.pages):
+        index.add("%08x" % i, {"kind": "png", "size": 5 * 2 ** 20, "width": 1920, "height": 1080,
+                               "created": time.time(), "thumbnail": True})
+    print("indexed %d pages in %.1fms" % (args.pages, (time.perf_counter() - started) * 1000))
+
+    # No page files exist at all, so any body access would fail.
+    server.user_drawings["bench"] = index
+    client = server.app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = "bench"
+    for offset in (0, args.pages // 2, args.pages - 50):
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            res = client.get("/pages?offset=%d&limit=50" % offset)
+            timings.append(time.perf_counter() - started)
+            assert res.status_code == 200 and len(res.get_json()["pages"]) == 50
+        print("GET /pages offset=%-6d p50 %.2fms p99 %.2fms" % (
+            offset, percentile(timings, 50) * 1000, percentile(timings, 99) * 1000))
+
+
+def write_stroke_log(path, strokes, segments_per_stroke):
+    with open(path, "w") as f:
+        for i in range(strokes):
+            for segment in sample_stroke(segments_per_stroke, start=0.1 + (i % 10) / 100):
+                segment["lastY"] = round(segment["lastY"] * 0.2 + i % 40 / 50, 4)
+                segment["y"] = round(segment["y"] * 0.2 + i % 40 / 50, 4)
+                f.write(json.dumps(segment) + "\n")
+
+
+def bench_render(args):
+    from concurrent.futures import ProcessPoolExecutor
+
+    from render import render_file
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "page.ndjson")
+        write_stroke_log(src, args.strokes, args.segments)
+        print("%-4s %-8s %12s %16s" % ("fmt", "workers", "pages/s", "pages/s/core"))
+        for fmt in args.formats:
+            for workers in sorted({1, args.workers}):
+                jobs = [(src, os.path.join(tmp, "out-%d.%s" % (i, fmt)), fmt, args.width, args.height)
+                        for i in range(args.pages)]
+                with ProcessPoolExecutor(workers) as pool:
+                    list(pool.map(render_file, *zip(*jobs[:workers])))  # warm up workers
+                    started = time.perf_counter()
+                    list(pool.map(render_file, *zip(*jobs)))
+                    rate = args.pages / (time.perf_counter() - started)
+                print("%-4s %-8d %12.1f %16.1f" % (fmt, workers, rate, rate / workers))
+
+
+def fill_board(board, segments, segments_per_stroke, authors=1, extent=1.0):
+    """Draw ``segments`` segments onto ``board`` as short strokes scattered
+    over an ``extent`` x ``extent`` board-unit square."""
+    import random
+
+    rng = random.Random(1)
+    for n in range(segments // segments_per_stroke):
+        x, y = rng.random() * extent, rng.random() * extent
+        author = "author-%d" % (n % authors)
+        for i in range(segments_per_stroke):
+            nx, ny = x + rng.uniform(-0.002, 0.002), y + rng.uniform(-0.002, 0.002)
+            board.add_segment(author, {"lastX": x, "lastY": y, "x": nx, "y": ny,
+                                       "color": "black", "erasing": False, "stroke": "s%d" % n})
+            x, y = nx, ny
+
+
+def bench_undo(args):
+    from board import Board
+
+    board = Board()
+    fill_board(board, args.segments, args.stroke_length)
+    pad = 0.01
+    undo_times, redraw_times = [], []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        stroke = board.undo("author-0")
+        undo_times.append(time.perf_counter() - started)
+        # What a viewer does next: find the strokes to repaint in the hole.
+        x0, y0, x1, y1 = stroke.bbox
+        started = time.perf_counter()
+        board.strokes_in((x0 - pad, y0 - pad, x1 + pad, y1 + pad))
+        redraw_times.append(time.perf_counter() - started)
+        board.redo("author-0")
+    print("%d segments in %d strokes" % (args.segments, len(board.strokes)))
+    print("undo:              p50 %.3fms p99 %.3fms" % (percentile(undo_times, 50) * 1000, percentile(undo_times, 99) * 1000))
+    print("recomposite query: p50 %.3fms p99 %.3fms" % (percentile(redraw_times, 50) * 1000, percentile(redraw_times, 99) * 1000))
+
+
+def bench_index(args):
+    from board import Board
+
+    boards = {}
+    for name, cell_size in (("linear", None), ("grid", args.cell_size)):
+        board = Board(cell_size=cell_size)
+        started = time.perf_counter()
+        fill_board(board, args.segments, args.stroke_length)
+        elapsed = time.perf_counter() - started
+        boards[name] = board
+        print("%-6s build %d segments: %.2fs (%.2fus/segment)" % (
+            name, args.segments, elapsed, elapsed / args.segments * 1e6))
+
+    for label, size in (("full page", 1.0), ("quarter", 0.5), ("zoomed 10x", 0.1), ("hit-test", 0.005)):
+        rect = (0.3, 0.3, 0.3 + size, 0.3 + size)
+        results = []
+        for name, board in boards.items():
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                hits = board.strokes_in(rect)
+                timings.append(time.perf_counter() - started)
+            results.append("%s p50 %.3fms" % (name, percentile(timings, 50) * 1000))
+        print("%-11s %6d strokes  %s" % (label, len(hits), "  ".join(results)))
+
+
+def bench_viewport(args):
+    from board import Board, BOARD_UNIT
+
+    board = Board()
+    fill_board(board, args.segments, args.stroke_length, extent=args.extent)
+    print("%d segments over a %gx%g board" % (args.segments, args.extent, args.extent))
+    print("%-8s %8s %10s %12s %12s" % ("zoom", "strokes", "points", "bytes", "time"))
+    for scale in (1.0, 0.1, 0.01, 0.001):
+        # A 1920x1080 window centred on the board
+        w, h = 1920 / (scale * BOARD_UNIT), 1080 / (scale * BOARD_UNIT)
+        cx = cy = args.extent / 2
+        rect = (cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2)
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            reply = board.viewport(rect, scale)
+            payload = json.dumps({"strokes": reply})
+            timings.append(time.perf_counter() - started)
+        points = sum(len(s["points"]) for s in reply)
+        print("%-8g %8d %10d %12d %10.1fms" % (
+            scale, len(reply), points, len(payload), percentile(timings, 50) * 1000))
+
+
+def bench_wal(args):
+    from board import Board
+    from wal import WriteAheadLog
+
+    directory = tempfile.mkdtemp(prefix="pad-wal-")
+    try:
+        for name in ("off", "on"):
+            board = Board()
+            wal = None
+            if name == "on":
+                wal = WriteAheadLog(os.path.join(directory, "wal"), args.flush_interval, args.batch)
+                board.journal = wal.append
+            started = time.perf_counter()
+            fill_board(board, args.segments, args.stroke_length)
+            if wal is not None:
+                wal.wait(wal.appended)
+            elapsed = time.perf_counter() - started
+            print("wal %-3s %d segments: %.2fs (%.0f segments/s)" % (
+                name, args.segments, elapsed, args.segments / elapsed))
+            if wal is not None:
+                wal.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_recovery(args):
+    from board import Board
+    from wal import WriteAheadLog
+
+    directory = tempfile.mkdtemp(prefix="pad-recovery-")
+    try:
+        # Write the segment file directly; going through the board would
+        # spend most of the run building state we are about to throw away.
+        written = records = 0
+        with open(os.path.join(directory, "wal-00000001.log"), "wb") as f:
+            x = y = 0.5
+            while written < args.size:
+                lines = []
+                for i in range(args.stroke_length):
+                    stroke = "s%d" % (records // args.stroke_length)
+                    author = "author-%d" % ((records // args.stroke_length) % 50)
+                    nx, ny = x + 0.0001 * ((i % 7) - 3), y + 0.0001 * ((i % 5) - 2)
+                    lines.append(json.dumps(["s", author, stroke, x, y, nx, ny, "black", False, i + 1],
+                                            separators=(",", ":")))
+                    x, y = nx, ny
+                    records += 1
+                data = ("\n".join(lines) + "\n").encode()
+                f.write(data)
+                written += len(data)
+        print("log: %d records, %.1f MiB" % (records, written / 2 ** 20))
+        board = Board()
+        wal = WriteAheadLog(directory)
+        started = time.perf_counter()
+        replayed = wal.recover(board.restore, board.apply)
+        elapsed = time.perf_counter() - started
+        wal.close()
+        print("recovery: %d records in %.1fs (%.0f records/s, %.1f MiB/s), %d strokes" % (
+            replayed, elapsed, replayed / elapsed, written / 2 ** 20 / elapsed, len(board.strokes)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_flood(args):
+    import socketio
+
+    scenarios = (
+        ("no flooder", {}, False),
+        ("flooder, unlimited", {"PAD_DRAW_RATE": "0"}, True),
+        ("flooder, limited", {"PAD_DRAW_OVERFLOW": args.policy}, True),
+    )
+    print("%-20s %10s %10s %10s %14s" % ("scenario", "delivered", "p50", "p99", "flood relayed"))
+    for name, env, flood in scenarios:
+        port = free_port()
+        server = start_server(port, **env)
+        url = "http://127.0.0.1:%d" % port
+        try:
+            sent_at = {}
+            latencies = []
+            flood_seen = [0]
+            viewer = socketio.Client()
+
+            @viewer.on("draw")
+            def on_draw(data):
+                started = sent_at.pop(data["stroke"], None)
+                if started is not None:
+                    latencies.append(time.perf_counter() - started)
+                elif data["stroke"].startswith("flood"):
+                    flood_seen[0] += 1
+
+            viewer.connect(url)
+            stop = threading.Event()
+
+            def flooder():
+                client = socketio.Client()
+                client.connect(url)
+                n = 0
+                while not stop.is_set() and client.connected:
+                    try:
+                        client.emit("draw", {"lastX": 0.5, "lastY": 0.5, "x": 0.6, "y": 0.6,
+                                             "stroke": "flood-%d" % (n // 50), "junk": "x" * args.junk})
+                    except socketio.exceptions.SocketIOError:
+                        break  # the "disconnect" policy hung up on us
+                    n += 1
+                client.disconnect()
+
+            def writer(i):
+                client = socketio.Client()
+                client.connect(url)
+                interval = 1.0 / args.rate
+                deadline = time.perf_counter() + args.duration
+                n = 0
+                while time.perf_counter() < deadline:
+                    # One stroke per segment, so each reply identifies its send time.
+                    stroke = "c%d-%d" % (i, n)
+                    sent_at[stroke] = time.perf_counter()
+                    client.emit("draw", {"lastX": 0.1, "lastY": 0.1 * i, "x": 0.2, "y": 0.1 * i, "stroke": stroke})
+                    n += 1
+                    time.sleep(interval)
+                client.disconnect()
+
+            if flood:
+                threading.Thread(target=flooder, daemon=True).start()
+                time.sleep(0.5)
+            with ThreadPoolExecutor(args.clients) as pool:
+                list(pool.map(writer, range(args.clients)))
+            time.sleep(1)
+            stop.set()
+            viewer.disconnect()
+            expected = args.clients * args.rate * args.duration
+            print("%-20s %9.0f%% %8.1fms %8.1fms %14d" % (
+                name, 100.0 * len(latencies) / expected, percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000, flood_seen[0]))
+        finally:
+            stop_server(server)
+
+
+def bench_startup(args):
+    import socketio
+
+    print("%-14s %12s %14s %14s" % ("scenario", "server up", "first window", "first stroke"))
+    for late in (0, args.late):
+        port = free_port()
+        url = "http://127.0.0.1:%d" % port
+        server = viewer = None
+        started = time.perf_counter()
+        try:
+            if not late:
+                server = start_server(port)
+                server_up = time.perf_counter() - started
+            env = dict(os.environ, PAD_SERVER=url, PAD_STARTUP_TRACE="1")
+            if not env.get("DISPLAY"):
+                env.setdefault("QT_QPA_PLATFORM", "offscreen")
+            viewer_started = time.perf_counter()
+            viewer = subprocess.Popen([sys.executable, os.path.join(HERE, "laptop.py")], env=env,
+                                      stdout=subprocess.PIPE, text=True)
+            marks = {}
+
+            def read_marks():
+                for line in viewer.stdout:
+                    name, _ = line.split()
+                    marks[name] = time.perf_counter() - viewer_started
+
+            threading.Thread(target=read_marks, daemon=True).start()
+            if late:
+                time.sleep(late)
+                server_started = time.perf_counter()
+                server = start_server(port)
+                server_up = time.perf_counter() - server_started
+            # Keep drawing until the viewer reports a painted remote stroke.
+            sender = socketio.Client()
+            sender.connect(url)
+            n = 0
+            deadline = time.perf_counter() + 60
+            while "stroke" not in marks and time.perf_counter() < deadline:
+                sender.emit("draw", {"lastX": 0.1, "lastY": 0.1, "x": 0.2 + 0.001 * n, "y": 0.2, "stroke": "startup"})
+                n += 1
+                time.sleep(0.01)
+            sender.disconnect()
+            label = "server late %gs" % late if late else "server up"
+            print("%-14s %10.0fms %12.0fms %12.0fms" % (
+                label, server_up * 1000, marks.get("window", float("nan")) * 1000,
+                marks.get("stroke", float("nan")) * 1000))
+        finally:
+            if viewer is not None:
+                viewer.kill()
+                viewer.wait()
+            if server is not None:
+                stop_server(server)
+
+
+def author_streams(authors, segments, stroke_length, retransmit):
+    """Draw messages of ``authors`` pads interleaved round-robin, with a
+    fraction ``retransmit`` of them sent a second time a little later."""
+    import random
+
+    rng = random.Random(1)
+    pens = [[rng.random(), rng.random(), 0] for _ in range(authors)]  # x, y, seq
+    messages = []
+    for n in range(segments):
+        a = n % authors
+        pen = pens[a]
+        seq = pen[2] = pen[2] + 1
+        nx, ny = pen[0] + rng.uniform(-0.002, 0.002), pen[1] + rng.uniform(-0.002, 0.002)
+        messages.append(("author-%d" % a, {"lastX": pen[0], "lastY": pen[1], "x": nx, "y": ny, "color": "black",
+                                           "stroke": "pad%d-%d" % (a, (seq - 1) // stroke_length), "seq": seq}))
+        pen[0], pen[1] = nx, ny
+        if rng.random() < retransmit:
+            messages.append(messages[-1 - rng.randrange(min(len(messages), authors * 4))])
+    return messages
+
+
+def bench_authors(args):
+    from board import Board
+    from limits import clean_segment
+
+    print("%-8s %10s %12s %14s %12s" % ("authors", "messages", "duplicates", "segments/s", "strokes"))
+    for authors in (1, args.authors):
+        messages = author_streams(authors, args.segments, args.stroke_length, args.retransmit)
+        board = Board()
+        dropped = 0
+        started = time.perf_counter()
+        for author, data in messages:
+            # What relay_draw does per message, minus the network
+            segment = clean_segment(data)
+            if board.add_segment(author, segment) is None:
+                dropped += 1
+        elapsed = time.perf_counter() - started
+        print("%-8d %10d %12d %14.0f %12d" % (authors, len(messages), dropped, len(messages) / elapsed, len(board.strokes)))
+
+
+def bench_ring(args):
+    import socketio
+    from ring import RingReader, RingWriter
+
+    name = "pad-bench-%d" % os.getpid()
+    # Raw ring: write and read back in one process, no relay involved
+    writer = RingWriter(name + "-raw", args.capacity)
+    reader = RingReader(name + "-raw", shm=writer.shm)
+    segment = {"lastX": 0.1, "lastY": 0.1, "x": 0.2, "y": 0.2, "erasing": False, "color": "black", "stroke": "s", "seq": 1}
+    started = time.perf_counter()
+    read = 0
+    for n in range(args.segments):
+        writer.write(segment, "bench")
+        if n % 1024 == 1023:
+            read += len(reader.poll())
+    read += len(reader.poll())
+    elapsed = time.perf_counter() - started
+    print("raw ring (%s): %.0f segments/s written and read" % (
+        "numpy" if reader.records is not None else "struct", read / elapsed))
+    writer.close()
+
+    # The ring viewer is set up as laptop.py does it: connected over
+    # Socket.IO too, having asked the relay to stop sending it draws there.
+    print("%-10s %14s %10s %10s %14s" % ("viewer", "segments/s", "p50", "p99", "socket draws"))
+    for transport in ("socketio", "ring"):
+        port = free_port()
+        server = start_server(port, PAD_SHM_RING=name, PAD_DRAW_RATE="0")
+        url = "http://127.0.0.1:%d" % port
+        try:
+            latencies = []
+            done = threading.Event()
+            stop = threading.Event()
+
+            def received(data):
+                # The sender puts its send time in "x"; perf_counter is
+                # system-wide on Linux, so it compares across processes.
+                latencies.append(time.perf_counter() - data["x"])
+                if len(latencies) == args.segments:
+                    done.set()
+
+            socket_draws = [0]
+
+            def socket_draw(data):
+                socket_draws[0] += 1
+                if transport == "socketio":
+                    received(data)
+
+            viewer = socketio.Client()
+            viewer.on("draw", socket_draw)
+            viewer.connect(url)
+            if transport == "ring":
+                reader = RingReader(name)
+                viewer.call("use_ring", timeout=10)
+
+                def poll():
+                    while not stop.is_set():
+                        messages = reader.poll()
+                        for data in messages:
+                            received(data)
+                        if not messages:
+                            time.sleep(0.0005)
+                    reader.close()
+
+                threading.Thread(target=poll, daemon=True).start()
+            sender = socketio.Client()
+            sender.connect(url)
+            started = time.perf_counter()
+            for n in range(args.segments):
+                sender.emit("draw", {"lastX": 0.1, "lastY": 0.1, "x": time.perf_counter(), "y": 0.2,
+                                     "stroke": "bench", "seq": n + 1})
+            done.wait(120)
+            elapsed = time.perf_counter() - started
+            stop.set()
+            sender.disconnect()
+            viewer.disconnect()
+            print("%-10s %14.0f %8.2fms %8.2fms %14d" % (
+                transport, len(latencies) / elapsed, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                socket_draws[0]))
+        finally:
+            stop_server(server)
+
+
+def bench_padtool(args):
+    import padtool
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "pages")
+        for i in range(args.pages):
+            directory = os.path.join(src, "user-%d" % (i % 10))
+            os.makedirs(directory, exist_ok=True)
+            write_stroke_log(os.path.join(directory, "page-%d.ndjson" % i), args.strokes, args.segments)
+        print("%-6s %-8s %10s %14s %14s" % ("fmt", "workers", "files/s", "segments/s", "segments out"))
+        for fmt in args.formats:
+            for workers in sorted({1, args.workers}):
+                out = os.path.join(tmp, "out-%s-%d" % (fmt, workers))
+                started = time.perf_counter()
+                totals = padtool.run([src], out, fmt, args.width, args.height, args.simplify, workers)
+                elapsed = time.perf_counter() - started
+                print("%-6s %-8d %10.1f %14.0f %14d" % (fmt, workers, totals["files"] / elapsed,
+                                                        totals["segments_in"] / elapsed, totals["segments_out"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("transport", help="bytes on the wire and connect-to-first-stroke time per transport profile")
+    p.add_argument("--segments", type=int, default=2000, help="draw events sent per run")
+    p.add_argument("--profiles", nargs="*", help="profiles to compare (default: all)")
+    p.set_defaults(run=bench_transport)
+
+    p = sub.add_parser("save", help="peak server RSS and latency for concurrent large saves")
+    p.add_argument("--requests", type=int, default=100, help="number of saves")
+    p.add_argument("--concurrency", type=int, default=100, help="saves in flight at once")
+    p.add_argument("--size", type=int, default=5 * 2 ** 20, help="page size in bytes")
+    p.add_argument("--modes", nargs="*", default=["json", "stream", "resumable"],
+                   help="json (legacy data URL), stream (raw body) or resumable (chunked upload)")
+    p.set_defaults(run=bench_save)
+
+    p = sub.add_parser("pages", help="page listing latency for a user with many saved pages")
+    p.add_argument("--pages", type=int, default=10000, help="pages in the user's index")
+    p.add_argument("--repeat", type=int, default=200, help="requests per offset")
+    p.set_defaults(run=bench_pages)
+
+    p = sub.add_parser("render", help="stroke-page render throughput per core")
+    p.add_argument("--pages", type=int, default=200, help="pages rendered per run")
+    p.add_argument("--strokes", type=int, default=200, help="strokes per page")
+    p.add_argument("--segments", type=int, default=50, help="segments per stroke")
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--formats", nargs="*", default=["png", "svg", "pdf"])
+    p.set_defaults(run=bench_render)
+
+    p = sub.add_parser("undo", help="cost of undoing the last stroke on a large board")
+    p.add_argument("--segments", type=int, default=100000)
+    p.add_argument("--stroke-length", type=int, default=50, help="segments per stroke")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(run=bench_undo)
+
+    p = sub.add_parser("index", help="spatial index query and maintenance cost")
+    p.add_argument("--segments", type=int, default=1000000)
+    p.add_argument("--stroke-length", type=int, default=50, help="segments per stroke")
+    p.add_argument("--cell-size", type=float, default=0.05)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(run=bench_index)
+
+    p = sub.add_parser("viewport", help="viewport reply size and time per zoom level")
+    p.add_argument("--segments", type=int, default=1000000)
+    p.add_argument("--stroke-length", type=int, default=200, help="segments per stroke")
+    p.add_argument("--extent", type=float, default=50.0, help="board side in board units")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(run=bench_viewport)
+
+    p = sub.add_parser("wal", help="stroke ingest rate with the write-ahead log on and off")
+    p.add_argument("--segments", type=int, default=1000000)
+    p.add_argument("--stroke-length", type=int, default=50, help="segments per stroke")
+    p.add_argument("--flush-interval", type=float, default=0.01, help="group commit interval in seconds")
+    p.add_argument("--batch", type=int, default=1024, help="records that force an early flush")
+    p.set_defaults(run=bench_wal)
+
+    p = sub.add_parser("recovery", help="time to replay a large write-ahead log on startup")
+    p.add_argument("--size", type=int, default=2 ** 30, help="log size in bytes")
+    p.add_argument("--stroke-length", type=int, default=50, help="segments per stroke")
+    p.set_defaults(run=bench_recovery)
+
+    p = sub.add_parser("flood", help="well-behaved clients' draw latency while one client floods the relay")
+    p.add_argument("--clients", type=int, default=10, help="well-behaved drawing clients")
+    p.add_argument("--rate", type=int, default=60, help="segments per second per well-behaved client")
+    p.add_argument("--duration", type=int, default=10, help="seconds each client draws")
+    p.add_argument("--junk", type=int, default=1024, help="bytes of unknown payload the flooder attaches")
+    p.add_argument("--policy", choices=["drop", "coalesce", "disconnect"], default="coalesce",
+                   help="overflow policy for the limited run")
+    p.set_defaults(run=bench_flood)
+
+    p = sub.add_parser("startup", help="laptop viewer time to first window and first remote stroke")
+    p.add_argument("--late", type=float, default=3.0, help="seconds the server starts after the viewer in the second run")
+    p.set_defaults(run=bench_startup)
+
+    p = sub.add_parser("authors", help="relay cost of many authors drawing at once, with retransmits")
+    p.add_argument("--authors", type=int, default=50)
+    p.add_argument("--segments", type=int, default=500000)
+    p.add_argument("--stroke-length", type=int, default=50, help="segments per stroke")
+    p.add_argument("--retransmit", type=float, default=0.05, help="fraction of messages sent twice")
+    p.set_defaults(run=bench_authors)
+
+    p = sub.add_parser("ring", help="same-host viewer: loopback Socket.IO against the shared-memory ring")
+    p.add_argument("--segments", type=int, default=20000)
+    p.add_argument("--capacity", type=int, default=65536, help="ring slots for the raw run")
+    p.set_defaults(run=bench_ring)
+
+    p = sub.add_parser("padtool", help="padtool.py batch conversion throughput, one worker against all cores")
+    p.add_argument("--pages", type=int, default=500)
+    p.add_argument("--strokes", type=int, default=200, help="strokes per page")
+    p.add_argument("--segments", type=int, default=20, help="segments per stroke")
+    p.add_argument("--formats", nargs="+", choices=["ndjson", "svg", "png", "pdf"], default=["ndjson", "svg"])
+    p.add_argument("--simplify", type=float, default=0.0005)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.set_defaults(run=bench_padtool)
+
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Stroke-level board state shared by the relay and the viewers.
+
+Draw segments are grouped into strokes so a whole stroke can be hidden or
+restored with one small message instead of resending pixels. A stroke
+belongs to the author who started it; segments another author sends under
+its id are refused. Each pad numbers its segments with a monotonic
+``seq``; a stroke keeps the seq of each of its points, so a segment
+retransmitted after a reconnect is recognised and dropped, and one that
+arrives late is put back in its place, however the streams of several
+authors interleave.
+
+The board is unbounded. Coordinates are board units, where one unit is
+BOARD_UNIT screen pixels at zoom 1; a view is an origin in board units
+plus a zoom scale.
+"""
+import math
+import threading
+from array import array
+from bisect import bisect_left
+from operator import attrgetter
+
+BOARD_UNIT = 1000
+CELL_SIZE = 0.05
+# Pyramid level L is simplified to LOD_TOLERANCE * 2**L board units;
+# level 0 is the stroke as drawn.
+LOD_TOLERANCE = 0.5 / BOARD_UNIT
+MAX_LOD = 16
+
+
+def lod_level(scale):
+    """Coarsest pyramid level that stays within half a pixel at ``scale``."""
+    tolerance = 0.5 / (BOARD_UNIT * scale)
+    if tolerance < 2 * LOD_TOLERANCE:
+        return 0
+    # min() first: a tiny scale makes the tolerance infinite
+    return int(min(MAX_LOD, math.log2(tolerance / LOD_TOLERANCE)))
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a polyline."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x0, y0), (x1, y1) = points[first], points[last]
+        dx, dy = x1 - x0, y1 - y0
+        length = math.hypot(dx, dy)
+        worst, worst_index = tolerance, None
+        for i in range(first + 1, last):
+            px, py = points[i]
+            if length:
+                distance = abs(dy * (px - x0) - dx * (py - y0)) / length
+            else:
+                distance = math.hypot(px - x0, py - y0)
+            if distance > worst:
+                worst, worst_index = distance, i
+        if worst_index is not None:
+            keep[worst_index] = True
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class Stroke:
+    __slots__ = ("id", "author", "color", "erasing", "points", "min_x", "min_y", "max_x", "max_y", "hidden", "order", "lod",
+                 "seq", "keys")
+
+    def __init__(self, stroke_id, author=None, color="black", erasing=False):
+        self.id = stroke_id
+        self.author = author
+        self.color = color or "black"
+        self.erasing = bool(erasing)
+        self.points = []
+        self.min_x = self.min_y = float("inf")
+        self.max_x = self.max_y = float("-inf")
+        self.hidden = False
+        self.order = 0
+        self.lod = None  # level: (points simplified, simplified points)
+        self.seq = 0  # highest segment sequence number taken
+        # Sort key of each point: 2 * seq for the end of segment seq, one
+        # less for a start point. None for strokes built without seqs.
+        self.keys = None
+
+    def add_point(self, x, y):
+        self.points.append((x, y))
+        self.grow(x, y)
+
+    def grow(self, x, y):
+        if x < self.min_x:
+            self.min_x = x
+        if x > self.max_x:
+            self.max_x = x
+        if y < self.min_y:
+            self.min_y = y
+        if y > self.max_y:
+            self.max_y = y
+
+    @property
+    def bbox(self):
+        return (self.min_x, self.min_y, self.max_x, self.max_y)
+
+    def intersects(self, rect):
+        x0, y0, x1, y1 = rect
+        return self.min_x <= x1 and self.max_x >= x0 and self.min_y <= y1 and self.max_y >= y0
+
+    def lod_points(self, level):
+        """The stroke simplified to pyramid ``level``, built from the level below."""
+        if level <= 0:
+            return self.points
+        if self.lod is None:
+            self.lod = {}
+        count = len(self.points)
+        cached = self.lod.get(level)
+        if cached is None or cached[0] != count:
+            cached = (count, simplify(self.lod_points(level - 1), LOD_TOLERANCE * 2 ** level))
+            self.lod[level] = cached
+        return cached[1]
+
+    def take(self, seq, start, end):
+        """Add one segment's points in seq order.
+
+        Returns False, changing nothing, for a seq the stroke already has.
+        A stroke whose points came without seqs (a viewport reply, an old
+        snapshot) only takes seqs above the highest it has seen.
+        """
+        if not self.points:
+            self.add_point(*start)
+            self.add_point(*end)
+            if seq is not None:
+                self.keys = array("q", (2 * seq - 1, 2 * seq))
+                self.seq = seq
+            return True
+        if seq is None or self.keys is None:
+            if seq is not None:
+                if seq <= self.seq:
+                    return False
+                self.seq = seq
+            self.add_point(*end)
+            if self.keys is not None:
+                self.keys.append(self.keys[-1])
+            return True
+        key = 2 * seq
+        keys = self.keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return False
+        if i == len(keys):
+            self.add_point(*end)
+            keys.append(key)
+        else:
+            # Arrived late, e.g. re-sent after segments drawn while offline
+            if keys[i] == key + 1:
+                # The next segment's start point, which this end replaces
+                self.points[i] = end
+                keys[i] = key
+            else:
+                self.points.insert(i, end)
+                keys.insert(i, key)
+            self.grow(*end)
+            if i == 0:
+                self.points.insert(0, start)
+                keys.insert(0, key - 1)
+                self.grow(*start)
+        self.seq = max(self.seq, seq)
+        return True
+
+    def to_dict(self, level=0):
+        return {"stroke": self.id, "author": self.author, "color": self.color, "erasing": self.erasing,
+                "points": list(self.lod_points(level)), "lod": level, "seq": self.seq}
+
+    def segments(self):
+        """The stroke as relay ``draw`` messages."""
+        for (x0, y0), (x1, y1) in zip(self.points, self.points[1:]):
+            yield {"lastX": x0, "lastY": y0, "x": x1, "y": y1,
+                   "erasing": self.erasing, "color": self.color, "stroke": self.id}
+
+
+class GridIndex:
+    """Uniform grid over stroke bounding boxes.
+
+    Each stroke is listed in every cell its bounding box overlaps. Strokes
+    only grow, so keeping the index current while a stroke is drawn costs
+    a cell-range comparison per segment and a few dict inserts when the
+    stroke crosses into new cells.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}  # (cx, cy): {stroke id: Stroke}
+        self.ranges = {}  # stroke id: (cx0, cy0, cx1, cy1) already indexed
+        self.count = 0
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        return (math.floor(rect[0] / size), math.floor(rect[1] / size),
+                math.floor(rect[2] / size), math.floor(rect[3] / size))
+
+    def update(self, stroke):
+        """Index a new stroke, or the cells a growing stroke has reached."""
+        new = self.cell_range(stroke.bbox)
+        old = self.ranges.get(stroke.id)
+        if old == new:
+            return
+        if old is None:
+            stroke.order = self.count
+            self.count += 1
+        self.ranges[stroke.id] = new
+        for cx in range(new[0], new[2] + 1):
+            for cy in range(new[1], new[3] + 1):
+                if old is None or not (old[0] <= cx <= old[2] and old[1] <= cy <= old[3]):
+                    self.cells.setdefault((cx, cy), {})[stroke.id] = stroke
+
+    def query(self, rect):
+        """Strokes whose bounding box touches ``rect``, in drawing order."""
+        cx0, cy0, cx1, cy1 = self.cell_range(rect)
+        found = {}
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            # Mostly empty space: walking the occupied cells is cheaper.
+            for (cx, cy), cell in self.cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    found.update(cell)
+        else:
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    cell = self.cells.get((cx, cy))
+                    if cell:
+                        found.update(cell)
+        hits = [stroke for stroke in found.values() if stroke.intersects(rect)]
+        hits.sort(key=attrgetter("order"))
+        return hits
+
+
+class Board:
+    """All strokes drawn on the shared board, with per-author undo/redo.
+
+    If ``journal`` is set it is called, under the board lock, with a
+    compact record of every change; ``apply`` replays such records.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE, journal=None):
+        self.journal = journal
+        self.lock = threading.RLock()
+        self.strokes = {}  # stroke id: Stroke, in drawing order
+        self.index = GridIndex(cell_size) if cell_size else None
+        self.undo_stacks = {}  # author: [stroke id, ...]
+        self.redo_stacks = {}  # author: [stroke id, ...]
+        self.open_strokes = {}  # author: last Stroke, for segments without a stroke id
+        self.next_id = 0
+
+    def stroke_for(self, author, data):
+        stroke_id = data.get("stroke")
+        if stroke_id is not None:
+            return str(stroke_id)[:64]
+        # Older clients send bare segments; a segment continues the author's
+        # last stroke when it starts where that stroke ended.
+        stroke = self.open_strokes.get(author)
+        if (stroke is not None and stroke.points[-1] == (data["lastX"], data["lastY"])
+                and stroke.color == (data.get("color") or "black")
+                and stroke.erasing == bool(data.get("erasing"))):
+            return stroke.id
+        self.next_id += 1
+        while "auto-%d" % self.next_id in self.strokes:
+            self.next_id += 1  # a client already sent this id itself
+        return "auto-%d" % self.next_id
+
+    def add_segment(self, author, data):
+        """Record one draw segment and return the stroke it belongs to.
+
+        Returns None for a segment the stroke already has, or for one sent
+        under the id of another author's stroke.
+        """
+        seq = data.get("seq")
+        with self.lock:
+            stroke_id = self.stroke_for(author, data)
+            stroke = self.strokes.get(stroke_id)
+            if stroke is not None and stroke.author != author:
+                return None
+            if stroke is None:
+                stroke = Stroke(stroke_id, author, data.get("color"), data.get("erasing"))
+                self.strokes[stroke_id] = stroke
+                self.undo_stacks.setdefault(author, []).append(stroke_id)
+                self.redo_stacks.pop(author, None)
+            if not stroke.take(seq, (data["lastX"], data["lastY"]), (data["x"], data["y"])):
+                return None
+            if self.index is not None:
+                self.index.update(stroke)
+            self.open_strokes[author] = stroke
+            if self.journal is not None:
+                self.journal(["s", author, stroke_id, data["lastX"], data["lastY"], data["x"], data["y"],
+                              stroke.color, stroke.erasing, seq])
+            return stroke
+
+    def undo(self, author):
+        """Hide the author's most recent visible stroke; returns it or None."""
+        with self.lock:
+            stack = self.undo_stacks.get(author, [])
+            while stack:
+                stroke = self.strokes.get(stack.pop())
+                if stroke is not None and not stroke.hidden:
+                    stroke.hidden = True
+                    self.redo_stacks.setdefault(author, []).append(stroke.id)
+                    self.open_strokes.pop(author, None)
+                    if self.journal is not None:
+                        self.journal(["u", author])
+                    return stroke
+            return None
+
+    def redo(self, author):
+        """Restore the author's most recently undone stroke; returns it or None."""
+        with self.lock:
+            stack = self.redo_stacks.get(author, [])
+            while stack:
+                stroke = self.strokes.get(stack.pop())
+                if stroke is not None and stroke.hidden:
+                    stroke.hidden = False
+                    self.undo_stacks.setdefault(author, []).append(stroke.id)
+                    if self.journal is not None:
+                        self.journal(["r", author])
+                    return stroke
+            return None
+
+    def apply(self, record):
+        """Replay one journal record."""
+        op, author = record[0], record[1]
+        if op == "s":
+            stroke_id, last_x, last_y, x, y, color, erasing = record[2:9]
+            seq = record[9] if len(record) > 9 else None
+            self.add_segment(author, {"lastX": last_x, "lastY": last_y, "x": x, "y": y,
+                                      "color": color, "erasing": erasing, "stroke": stroke_id, "seq": seq})
+        elif op == "u":
+            self.undo(author)
+        elif op == "r":
+            self.redo(author)
+
+    def snapshot(self):
+        """Copy of the board state that can be serialized outside the lock."""
+        with self.lock:
+            return {
+                "strokes": [[s.id, s.author, s.color, s.erasing, s.hidden, list(s.points), s.seq,
+                             None if s.keys is None else list(s.keys)]
+                            for s in self.strokes.values()],
+                "undo": {author: list(stack) for author, stack in self.undo_stacks.items()},
+                "redo": {author: list(stack) for author, stack in self.redo_stacks.items()},
+                "next_id": self.next_id,
+            }
+
+    def restore(self, state):
+        with self.lock:
+            for entry in state["strokes"]:
+                stroke_id, author, color, erasing, hidden, points = entry[:6]
+                stroke = Stroke(stroke_id, author, color, erasing)
+                for x, y in points:
+                    stroke.add_point(x, y)
+                stroke.hidden = hidden
+                stroke.seq = entry[6] if len(entry) > 6 else 0
+                if len(entry) > 7 and entry[7] is not None:
+                    stroke.keys = array("q", entry[7])
+                self.strokes[stroke_id] = stroke
+                if self.index is not None:
+                    self.index.update(stroke)
+            self.undo_stacks = {author: list(stack) for author, stack in state["undo"].items()}
+            self.redo_stacks = {author: list(stack) for author, stack in state["redo"].items()}
+            self.next_id = state["next_id"]
+
+    def viewport(self, rect, scale=1.0):
+        """Visible strokes in ``rect`` at the level of detail for ``scale``."""
+        level = lod_level(scale)
+        return [stroke.to_dict(level) for stroke in self.strokes_in(rect)]
+
+    def strokes_in(self, rect):
+        """Visible strokes whose bounding box touches ``rect``."""
+        if not all(math.isfinite(v) for v in rect):
+            return []
+        with self.lock:
+            if self.index is None:
+                return [s for s in self.strokes.values() if not s.hidden and s.intersects(rect)]
+            return [s for s in self.index.query(rect) if not s.hidden]
@@ -1,11 +1,55 @@
+import os
 import sys
-import socketio
+import threading
+import time
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget
-from PyQt5.QtGui import QPainter, QPen
-from PyQt5.QtCore import Qt, QPoint
+from PyQt5.QtGui import QPainter, QPen, QPixmap, QColor, QPolygonF
+from PyQt5.QtCore import Qt, QRect, QPointF, QTimer, pyqtSignal
 
-sio = socketio.Client()
-sio.connect("http://localhost:5000")
+from board import Stroke, GridIndex, BOARD_UNIT
+from profiling import Profiler
+
+STARTED = time.perf_counter()
+SERVER_URL = os.environ.get("PAD_SERVER", "http://localhost:5000")
+# Name of the relay's shared-memory ring (PAD_SHM_RING on the server); when
+# it can be opened, draw segments are read from it instead of Socket.IO.
+RING_NAME = os.environ.get("PAD_SHM_RING")
+RING_POLL_INTERVAL = 4  # ms
+PEN_WIDTH = 3
+ERASER_WIDTH = 20
+MIN_SCALE = 0.01
+MAX_SCALE = 100
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 10
+
+marks_reached = set()
+
+
+def startup_mark(name):
+    """With PAD_STARTUP_TRACE set, print when a startup milestone is first reached."""
+    if name not in marks_reached and os.environ.get("PAD_STARTUP_TRACE"):
+        marks_reached.add(name)
+        print("%s %.3f" % (name, time.perf_counter() - STARTED), flush=True)
+
+
+def connect_loop(canvas, url):
+    """Connect in the background, retrying with backoff until the relay is up.
+
+    After the first connection the client reconnects by itself; every
+    (re)connect fires ``connect``, which makes the canvas resync.
+    """
+    import socketio  # kept off the path to the first window
+
+    sio = socketio.Client(reconnection_delay=RETRY_DELAY, reconnection_delay_max=MAX_RETRY_DELAY)
+    canvas.attach(sio)
+    delay = RETRY_DELAY
+    while True:
+        try:
+            sio.connect(url)
+            return
+        except socketio.exceptions.ConnectionError:
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
 
 class DisplayApp(QMainWindow):
     def __init__(self):
@@ -16,24 +60,272 @@ class DisplayApp(QMainWindow):
         self.setCentralWidget(self.canvas)
 
 class DisplayCanvas(QWidget):
+    # Socket.IO callbacks run on the client's thread; signals hand the
+    # messages to the Qt thread.
+    segment_received = pyqtSignal(dict)
+    strokes_received = pyqtSignal(list)
+    visibility_changed = pyqtSignal(str, bool)
+    connected = pyqtSignal()
+    disconnected = pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.lines = []
+        self.strokes = {}  # stroke id: Stroke, in drawing order
+        self.detail = {}  # stroke id: pyramid level of the points we hold
+        self.pens = {}  # author: ((color, erasing, scale), QPen)
+        self.index = GridIndex()
+        # View onto the unbounded board: top-left corner in board units
+        # and zoom. Drag to pan, wheel to zoom.
+        self.view_x = 0.0
+        self.view_y = 0.0
+        self.scale = 1.0
+        self.drag_from = None
+        # Everything visible is painted once into this layer; paintEvent
+        # only copies the exposed part of it.
+        self.layer = QPixmap(1, 1)
+        self.layer.fill(Qt.white)
+        self.sio = None
+        self.online = False
+        self.resync_rect = None  # area whose next viewport reply is authoritative
+        self.stroke_painted = False
+        self.ring = None
+        self.ring_timer = QTimer(self)
+        self.ring_timer.setInterval(RING_POLL_INTERVAL)
+        self.ring_timer.timeout.connect(self.poll_ring)
+        self.viewport_timer = QTimer(self)
+        self.viewport_timer.setSingleShot(True)
+        self.viewport_timer.setInterval(100)
+        self.viewport_timer.timeout.connect(self.request_viewport)
+        self.segment_received.connect(self.add_segment)
+        self.strokes_received.connect(self.add_strokes)
+        self.visibility_changed.connect(self.set_hidden)
+        self.connected.connect(self.resync)
+        self.disconnected.connect(self.went_offline)
+        self.show_status("connecting")
+        self.profiler = Profiler.from_env()
+        self.profiler.install(self)
 
-        @sio.on("draw")
-        def receive_draw(data):
-            self.lines.append(data)
-            self.update()
+    def attach(self, sio):
+        """Route a Socket.IO client's events to this canvas."""
+        sio.on("draw", self.receive_draw)
+        sio.on("strokes", lambda data: self.strokes_received.emit(data["strokes"]))
+        sio.on("hide_stroke", lambda data: self.visibility_changed.emit(data["stroke"], True))
+        sio.on("restore_stroke", lambda data: self.visibility_changed.emit(data["stroke"], False))
+        sio.on("connect", lambda *args: self.connected.emit())
+        sio.on("disconnect", lambda *args: self.disconnected.emit())
+        self.sio = sio
 
-    def paintEvent(self, event):
-        painter = QPainter(self)
-        painter.setPen(QPen(Qt.black, 3, Qt.SolidLine))
+    def receive_draw(self, data):
+        self.profiler.count("received")
+        # Draws already queued when we switched to the ring can still arrive
+        if self.ring is None:
+            self.segment_received.emit(data)
+
+    def open_ring(self):
+        """Switch draw segments to the relay's ring if it is on this machine."""
+        if self.ring is not None:
+            # The relay may have restarted with a new ring
+            self.ring_timer.stop()
+            self.ring.close()
+            self.ring = None
+        if not RING_NAME:
+            return
+        from ring import RingReader
+        try:
+            self.ring = RingReader(RING_NAME)
+        except (OSError, ValueError):
+            return  # not on the relay's host: stay on Socket.IO
+        self.ring_timer.start()
+        # Only now, so no segment falls between the two paths
+        self.sio.emit("use_ring")
+
+    def poll_ring(self):
+        for data in self.ring.poll():
+            self.profiler.count("received")
+            self.add_segment(data)
+        if self.ring.lost:
+            # Fell a whole ring behind; fetch what we missed.
+            self.ring.lost = 0
+            self.resync()
+
+    def show_status(self, status):
+        title = "Laptop Display Screen"
+        self.window().setWindowTitle("%s (%s)" % (title, status) if status else title)
+
+    def resync(self):
+        """After a (re)connect, replace what we show with the relay's view of it."""
+        self.online = True
+        self.show_status(None)
+        self.open_ring()
+        self.resync_rect = self.visible_rect()
+        self.request_viewport()
+
+    def went_offline(self):
+        self.online = False
+        self.show_status("reconnecting")
+
+    def visible_rect(self):
+        top_left = self.to_board(0, 0)
+        bottom_right = self.to_board(self.width(), self.height())
+        return top_left + bottom_right
+
+    def request_viewport(self):
+        """Ask the relay for the visible strokes at this zoom's detail."""
+        if not self.online:
+            return
+        x0, y0, x1, y1 = self.visible_rect()
+        self.sio.emit("viewport", {"x0": x0, "y0": y0, "x1": x1, "y1": y1, "scale": self.scale})
 
-        for line in self.lines:
-            painter.drawLine(line["x1"], line["y1"], line["x2"], line["y2"])
+    def pen_for(self, stroke):
+        """The stroke author's pen; kept per author so interleaved authors don't rebuild pens."""
+        key = (stroke.color, stroke.erasing, self.scale)
+        cached = self.pens.get(stroke.author)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if stroke.erasing:
+            pen = QPen(Qt.white, ERASER_WIDTH * self.scale, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        else:
+            pen = QPen(QColor(stroke.color), PEN_WIDTH * self.scale, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+        self.pens[stroke.author] = (key, pen)
+        return pen
+
+    def to_pixels(self, x, y):
+        return QPointF((x - self.view_x) * self.scale * BOARD_UNIT, (y - self.view_y) * self.scale * BOARD_UNIT)
+
+    def to_board(self, px, py):
+        return (px / (self.scale * BOARD_UNIT) + self.view_x, py / (self.scale * BOARD_UNIT) + self.view_y)
+
+    def stroke_rect(self, stroke):
+        """Pixel rectangle covered by a stroke, including the pen width."""
+        pad = int(ERASER_WIDTH * self.scale) + 2
+        top_left = self.to_pixels(stroke.min_x, stroke.min_y)
+        bottom_right = self.to_pixels(stroke.max_x, stroke.max_y)
+        left, top = int(top_left.x()), int(top_left.y())
+        right, bottom = int(bottom_right.x()), int(bottom_right.y())
+        return QRect(left - pad, top - pad, right - left + 2 * pad, bottom - top + 2 * pad)
+
+    def draw_stroke(self, painter, stroke):
+        painter.setPen(self.pen_for(stroke))
+        painter.drawPolyline(QPolygonF([self.to_pixels(x, y) for x, y in stroke.points]))
+
+    def add_segment(self, data):
+        self.profiler.count("processed")
+        stroke = self.strokes.get(data["stroke"])
+        if stroke is None:
+            stroke = Stroke(data["stroke"], data.get("author"), data.get("color"), data.get("erasing"))
+            self.strokes[stroke.id] = stroke
+            self.detail[stroke.id] = 0
+        if not stroke.take(data.get("seq"), (data["lastX"], data["lastY"]), (data["x"], data["y"])):
+            return  # retransmitted after a reconnect
+        self.index.update(stroke)
+        if stroke.hidden:
+            return
+        painter = QPainter(self.layer)
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(self.pen_for(stroke))
+        painter.drawLine(self.to_pixels(data["lastX"], data["lastY"]), self.to_pixels(data["x"], data["y"]))
+        painter.end()
+        self.update(self.stroke_rect(stroke))
+        self.stroke_painted = True
+
+    def add_strokes(self, strokes):
+        """Take strokes from a viewport reply; a coarser copy never replaces finer points."""
+        if self.resync_rect is not None:
+            # Strokes undone or redone while we were offline: the reply
+            # lists exactly the visible strokes in the area.
+            listed = {data["stroke"] for data in strokes}
+            for stroke in self.index.query(self.resync_rect):
+                stroke.hidden = stroke.id not in listed
+            self.resync_rect = None
+        for data in strokes:
+            stroke = self.strokes.get(data["stroke"])
+            level = data.get("lod", 0)
+            if stroke is not None:
+                stroke.seq = max(stroke.seq, data.get("seq", 0))
+                held = self.detail.get(stroke.id, 0)
+                if held < level or (held == level and len(stroke.points) >= len(data["points"])):
+                    continue
+            else:
+                stroke = Stroke(data["stroke"], data.get("author"), data["color"], data["erasing"])
+                stroke.seq = data.get("seq", 0)
+                self.strokes[stroke.id] = stroke
+            stroke.points = []
+            stroke.keys = None
+            for x, y in data["points"]:
+                stroke.add_point(x, y)
+            self.detail[stroke.id] = level
+            self.index.update(stroke)
+        self.recomposite(self.rect())
+
+    def set_hidden(self, stroke_id, hidden):
+        stroke = self.strokes.get(stroke_id)
+        if stroke is None or stroke.hidden == hidden:
+            return
+        stroke.hidden = hidden
+        self.recomposite(self.stroke_rect(stroke))
+
+    def recomposite(self, rect):
+        """Repaint ``rect`` of the layer from the strokes that touch it."""
+        pad = int(ERASER_WIDTH * self.scale) + 2
+        area = (self.to_board(rect.left() - pad, rect.top() - pad)
+                + self.to_board(rect.right() + pad, rect.bottom() + pad))
+        with self.profiler.span("recomposite"):
+            painter = QPainter(self.layer)
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.setClipRect(rect)
+            painter.fillRect(rect, Qt.white)
+            for stroke in self.index.query(area):
+                if not stroke.hidden:
+                    self.draw_stroke(painter, stroke)
+            painter.end()
+        self.update(rect)
+
+    def view_changed(self):
+        self.recomposite(self.rect())
+        self.viewport_timer.start()
+
+    def mousePressEvent(self, event):
+        self.drag_from = event.pos()
+
+    def mouseMoveEvent(self, event):
+        if self.drag_from is None:
+            return
+        delta = event.pos() - self.drag_from
+        self.drag_from = event.pos()
+        self.view_x -= delta.x() / (self.scale * BOARD_UNIT)
+        self.view_y -= delta.y() / (self.scale * BOARD_UNIT)
+        self.view_changed()
+
+    def mouseReleaseEvent(self, event):
+        self.drag_from = None
+
+    def wheelEvent(self, event):
+        """Zoom around the cursor"""
+        anchor_x, anchor_y = self.to_board(event.pos().x(), event.pos().y())
+        factor = 1.0015 ** event.angleDelta().y()
+        self.scale = min(MAX_SCALE, max(MIN_SCALE, self.scale * factor))
+        self.view_x = anchor_x - event.pos().x() / (self.scale * BOARD_UNIT)
+        self.view_y = anchor_y - event.pos().y() / (self.scale * BOARD_UNIT)
+        self.view_changed()
+
+    def resizeEvent(self, event):
+        self.layer = QPixmap(self.size())
+        self.layer.fill(Qt.white)
+        self.view_changed()
+
+    def paintEvent(self, event):
+        self.profiler.count("frames")
+        with self.profiler.span("paint"):
+            painter = QPainter(self)
+            painter.drawPixmap(event.rect(), self.layer, event.rect())
+            painter.end()
+        startup_mark("window")
+        if self.stroke_painted:
+            startup_mark("stroke")
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = DisplayApp()
     window.show()
+    threading.Thread(target=connect_loop, args=(window.canvas, SERVER_URL), daemon=True).start()
     sys.exit(app.exec_())
@@ -0,0 +1,192 @@
+"""Flood protection for the relay's draw events.
+
+Every draw is checked against a token bucket for its socket and, for
+signed-in users, one for the user, so opening several tabs does not
+multiply a user's allowance. Payloads are rebuilt from the known fields
+before fan-out; anything else a client sends is never relayed.
+"""
+import math
+import re
+import threading
+import time
+
+# Segments per second and burst size per socket and per user.
+DRAW_RATE = 500
+DRAW_BURST = 1000
+USER_DRAW_RATE = 1000
+USER_DRAW_BURST = 2000
+MAX_COORDINATE = 1e9
+MAX_STROKE_ID = 64
+MAX_SEQ = 2 ** 53
+MAX_PENDING_STROKES = 8
+overflow_policies = ("drop", "coalesce", "disconnect")
+
+color_pattern = re.compile(r"^#?[0-9A-Za-z]{1,20}$")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def ready(self, now):
+        """Refill for the time since the last call; True if a token is available."""
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.stamp = now
+        return self.tokens >= 1
+
+
+class RateLimiter:
+    """Token buckets per socket and per user.
+
+    ``allow`` takes a token from both buckets or from neither, so a
+    socket is not charged for a segment its user's bucket refused. A rate
+    of 0 turns the limiter off.
+    """
+
+    def __init__(self, rate=DRAW_RATE, burst=DRAW_BURST, user_rate=USER_DRAW_RATE, user_burst=USER_DRAW_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.sockets = {}  # sid: TokenBucket
+        self.users = {}  # username: TokenBucket
+
+    def allow(self, sid, username=None, now=None):
+        if not self.rate:
+            return True
+        if now is None:
+            now = time.monotonic()
+        bucket = self.sockets.get(sid)
+        if bucket is None:
+            bucket = self.sockets[sid] = TokenBucket(self.rate, self.burst, now)
+        if not bucket.ready(now):
+            return False
+        if username:
+            user_bucket = self.users.get(username)
+            if user_bucket is None:
+                user_bucket = self.users[username] = TokenBucket(self.user_rate, self.user_burst, now)
+            if not user_bucket.ready(now):
+                return False
+            user_bucket.tokens -= 1
+        bucket.tokens -= 1
+        return True
+
+    def forget(self, sid):
+        self.sockets.pop(sid, None)
+
+
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("not a number")
+    if not math.isfinite(value) or abs(value) > MAX_COORDINATE:
+        raise ValueError("coordinate out of range")
+    return value
+
+
+def clean_segment(data):
+    """The draw segment rebuilt from its known fields, or None if it is malformed."""
+    if not isinstance(data, dict):
+        return None
+    try:
+        segment = {key: number(data[key]) for key in ("lastX", "lastY", "x", "y")}
+    except (KeyError, ValueError):
+        return None
+    color = data.get("color")
+    segment["color"] = color if isinstance(color, str) and color_pattern.match(color) else "black"
+    segment["erasing"] = data.get("erasing") is True
+    stroke = data.get("stroke")
+    if stroke is not None:
+        if not isinstance(stroke, (str, int)) or isinstance(stroke, bool) or len(str(stroke)) > MAX_STROKE_ID:
+            return None
+        segment["stroke"] = str(stroke)
+    seq = data.get("seq")
+    if seq is not None:
+        if isinstance(seq, bool) or not isinstance(seq, int) or not 0 < seq <= MAX_SEQ:
+            return None
+        segment["seq"] = seq
+    return segment
+
+
+def extend(waiting, segment):
+    """Stretch a held segment to end where ``segment`` ends."""
+    waiting["x"], waiting["y"] = segment["x"], segment["y"]
+    if "seq" in segment:
+        waiting["seq"] = segment["seq"]
+
+
+class Coalescer:
+    """Holds over-limit segments for the "coalesce" overflow policy.
+
+    Over-limit segments of one stroke are merged into a single pending
+    segment running from where the stroke was last relayed to its newest
+    point, so a flooding pen loses detail rather than position. At most
+    ``max_strokes`` strokes are held per socket; beyond that segments are
+    dropped.
+    """
+
+    def __init__(self, max_strokes=MAX_PENDING_STROKES):
+        self.max_strokes = max_strokes
+        self.lock = threading.Lock()
+        self.pending = {}  # sid: (author, username, {stroke key: segment})
+
+    def hold(self, sid, author, username, segment):
+        """Queue ``segment``; returns False if it had to be dropped."""
+        key = segment.get("stroke")
+        with self.lock:
+            entry = self.pending.get(sid)
+            if entry is None:
+                entry = self.pending[sid] = (author, username, {})
+            held = entry[2]
+            waiting = held.get(key)
+            if waiting is not None:
+                # Segments without a stroke id only merge when they join up.
+                if key is None and (waiting["x"], waiting["y"]) != (segment["lastX"], segment["lastY"]):
+                    return False
+                extend(waiting, segment)
+                return True
+            if len(held) >= self.max_strokes:
+                return False
+            held[key] = segment
+            return True
+
+    def merge(self, sid, segment):
+        """Fold a held segment of the same stroke into ``segment`` before relaying it."""
+        if sid not in self.pending:
+            return segment
+        with self.lock:
+            entry = self.pending.get(sid)
+            if entry is None:
+                return segment
+            waiting = entry[2].pop(segment.get("stroke"), None)
+            if not entry[2]:
+                del self.pending[sid]
+        if waiting is None:
+            return segment
+        extend(waiting, segment)
+        return waiting
+
+    def senders(self):
+        with self.lock:
+            return [(sid, entry[0], entry[1]) for sid, entry in self.pending.items()]
+
+    def pop(self, sid):
+        """The oldest held segment of ``sid``, or None."""
+        with self.lock:
+            entry = self.pending.get(sid)
+            if entry is None:
+                return None
+            held = entry[2]
+            segment = held.pop(next(iter(held)))
+            if not held:
+                del self.pending[sid]
+            return segment
+
+    def forget(self, sid):
+        with self.lock:
+            self.pending.pop(sid, None)
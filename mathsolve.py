@@ -0,0 +1,288 @@
+"""Handwritten arithmetic: stroke grouping, symbol recognition and evaluation.
+
+Strokes on the board are grouped into expression regions (strokes that
+sit on one line, close together), each region is cut into symbols (strokes
+whose horizontal extents overlap), and each symbol is recognized by
+point-cloud template matching against a small built-in set of glyphs.
+The recognized text is evaluated with a whitelist of arithmetic
+operations; nothing is ever passed to ``eval``.
+
+Recognition is CPU-bound and runs in worker processes via
+``recognize_batch``; grouping and hashing are cheap and run in the relay.
+"""
+import ast
+import hashlib
+import math
+import operator
+import re
+import struct
+from collections import OrderedDict
+
+RESAMPLE_POINTS = 24
+MAX_REGION_STROKES = 64
+# Most ink one solve request may ask the relay to group and hash.
+MAX_SOLVE_STROKES = 512
+MAX_SOLVE_POINTS = 50000
+MAX_EXPRESSION = 64
+CACHE_SIZE = 4096
+# Handwritten digits and brackets are about this much narrower than tall;
+# glyphs below are drawn square and narrowed when the templates are built.
+NARROW_WIDTH = 0.6
+narrow_symbols = set("0123456789()")
+
+# Glyphs as strokes of points in a unit box, y pointing down. Some symbols
+# have more than one common way of being written.
+glyphs = {
+    "0": [[[0.5 + 0.35 * math.sin(2 * math.pi * i / 16), 0.5 - 0.5 * math.cos(2 * math.pi * i / 16)]
+           for i in range(17)]],
+    "1": [[[0.5, 0], [0.5, 1]]],
+    "1'": [[[0.25, 0.25], [0.5, 0], [0.5, 1]]],
+    "2": [[[0.1, 0.25], [0.3, 0.02], [0.7, 0.02], [0.9, 0.25], [0.85, 0.45], [0.1, 1], [0.9, 1]]],
+    "3": [[[0.1, 0.1], [0.5, 0], [0.85, 0.15], [0.85, 0.35], [0.45, 0.5], [0.9, 0.65], [0.9, 0.88],
+           [0.5, 1], [0.1, 0.9]]],
+    "4": [[[0.7, 1], [0.7, 0], [0.05, 0.7], [0.95, 0.7]]],
+    "4'": [[[0.15, 0], [0.1, 0.6], [0.9, 0.6]], [[0.7, 0.2], [0.7, 1]]],
+    "5": [[[0.2, 0], [0.15, 0.45], [0.6, 0.4], [0.9, 0.6], [0.85, 0.9], [0.5, 1], [0.1, 0.9]],
+          [[0.2, 0], [0.85, 0]]],
+    "6": [[[0.8, 0.05], [0.4, 0.1], [0.15, 0.5], [0.2, 0.9], [0.5, 1], [0.85, 0.85], [0.85, 0.6],
+           [0.5, 0.45], [0.15, 0.65]]],
+    "7": [[[0.1, 0], [0.9, 0], [0.35, 1]]],
+    "8": [[[0.85, 0.15], [0.5, 0], [0.15, 0.15], [0.2, 0.35], [0.8, 0.65], [0.85, 0.88], [0.5, 1],
+           [0.15, 0.88], [0.2, 0.65], [0.8, 0.35], [0.85, 0.15]]],
+    "9": [[[0.85, 0.25], [0.5, 0.45], [0.15, 0.3], [0.3, 0.02], [0.7, 0.02], [0.85, 0.25], [0.8, 1]]],
+    "+": [[[0.5, 0], [0.5, 1]], [[0, 0.5], [1, 0.5]]],
+    "-": [[[0, 0.5], [1, 0.5]]],
+    "*": [[[0, 0], [1, 1]], [[1, 0], [0, 1]]],
+    "/": [[[1, 0], [0, 1]]],
+    "=": [[[0, 0.3], [1, 0.3]], [[0, 0.7], [1, 0.7]]],
+    "(": [[[0.7, 0], [0.35, 0.3], [0.3, 0.5], [0.35, 0.7], [0.7, 1]]],
+    ")": [[[0.3, 0], [0.65, 0.3], [0.7, 0.5], [0.65, 0.7], [0.3, 1]]],
+}
+
+operators = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+
+def resample(strokes, n=RESAMPLE_POINTS):
+    """``n`` points spread evenly along the strokes' combined path length."""
+    length = sum(math.dist(a, b) for stroke in strokes for a, b in zip(stroke, stroke[1:]))
+    if not length:
+        x, y = strokes[0][0]
+        return [(x, y)] * n
+    step = length / (n - 1)
+    points = [tuple(strokes[0][0])]
+    carried = 0.0
+    for stroke in strokes:
+        for (x0, y0), (x1, y1) in zip(stroke, stroke[1:]):
+            d = math.dist((x0, y0), (x1, y1))
+            while d and carried + d >= step and len(points) < n:
+                t = (step - carried) / d
+                x0, y0 = x0 + t * (x1 - x0), y0 + t * (y1 - y0)
+                points.append((x0, y0))
+                d = math.dist((x0, y0), (x1, y1))
+                carried = 0.0
+            carried += d
+    while len(points) < n:
+        points.append(tuple(strokes[-1][-1]))
+    return points
+
+
+def normalize(points):
+    """Scale to a unit box keeping the aspect ratio, centred on the centroid."""
+    xs, ys = [x for x, _ in points], [y for _, y in points]
+    size = max(max(xs) - min(xs), max(ys) - min(ys)) or 1.0
+    cx, cy = sum(xs) / len(xs), sum(ys) / len(ys)
+    return [((x - cx) / size, (y - cy) / size) for x, y in points]
+
+
+def cloud_distance(a, b, start):
+    """Greedy point-cloud matching cost, as in the $P recognizer."""
+    n = len(a)
+    matched = [False] * n
+    total = 0.0
+    i = start
+    for k in range(n):
+        ax, ay = a[i]
+        best, best_j = float("inf"), 0
+        for j in range(n):
+            if not matched[j]:
+                bx, by = b[j]
+                d = (ax - bx) ** 2 + (ay - by) ** 2
+                if d < best:
+                    best, best_j = d, j
+        matched[best_j] = True
+        total += (1 - k / n) * math.sqrt(best)
+        i = (i + 1) % n
+    return total
+
+
+def match_cost(a, b):
+    step = max(1, int(len(a) ** 0.5))
+    return min(min(cloud_distance(a, b, i), cloud_distance(b, a, i)) for i in range(0, len(a), step))
+
+
+template_clouds = None
+
+
+def templates():
+    global template_clouds
+    if template_clouds is None:
+        template_clouds = []
+        for name, strokes in glyphs.items():
+            symbol = name[0]
+            if symbol in narrow_symbols:
+                strokes = [[(x * NARROW_WIDTH, y) for x, y in stroke] for stroke in strokes]
+            template_clouds.append((symbol, normalize(resample(strokes))))
+    return template_clouds
+
+
+def recognize_symbol(strokes):
+    cloud = normalize(resample(strokes))
+    return min(templates(), key=lambda template: match_cost(cloud, template[1]))[0]
+
+
+def recognize_batch(items):
+    """Worker entry point: ``[(key, symbols)]`` to ``[(key, text)]``, where
+    each symbol is a list of strokes and each stroke a list of points."""
+    return [(key, "".join(recognize_symbol(symbol) for symbol in symbols)) for key, symbols in items]
+
+
+def group_regions(strokes):
+    """Cluster strokes into expression regions; each is a list of strokes."""
+    strokes = [s for s in strokes if not s.erasing and s.points]
+    if not strokes:
+        return []
+    # The line height comes from the upright strokes (digits, brackets,
+    # the bar of a plus); flat ones such as minus signs and the bars of an
+    # equals sign say nothing about it.
+    heights = sorted(s.max_y - s.min_y for s in strokes if s.max_y - s.min_y >= s.max_x - s.min_x)
+    if not heights:
+        heights = [max(s.max_y - s.min_y, s.max_x - s.min_x) for s in strokes]
+    line = max(heights[len(heights) // 2], 1e-6)
+    # Union every pair of strokes that sit on one line within a gap of
+    # one line height.
+    parent = list(range(len(strokes)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    order = sorted(range(len(strokes)), key=lambda i: strokes[i].min_x)
+    for a_pos, a in enumerate(order):
+        sa = strokes[a]
+        for b in order[a_pos + 1:]:
+            sb = strokes[b]
+            if sb.min_x > sa.max_x + line:
+                break
+            if sb.min_y <= sa.max_y + line / 2 and sb.max_y >= sa.min_y - line / 2:
+                parent[root(a)] = root(b)
+    regions = {}
+    for i in order:
+        regions.setdefault(root(i), []).append(strokes[i])
+    return [region for region in regions.values() if len(region) <= MAX_REGION_STROKES]
+
+
+def split_symbols(region):
+    """Left-to-right symbols of a region: strokes whose x-extents mostly overlap."""
+    symbols = []
+    for stroke in sorted(region, key=lambda s: s.min_x):
+        if symbols:
+            symbol = symbols[-1]
+            x0, x1 = symbol[0], symbol[1]
+            overlap = min(x1, stroke.max_x) - max(x0, stroke.min_x)
+            narrower = min(x1 - x0, stroke.max_x - stroke.min_x)
+            # A perfectly vertical stroke is zero wide; it joins when it
+            # lies within the symbol's extent.
+            if overlap >= 0 and overlap >= narrower / 2:
+                symbol[0], symbol[1] = min(x0, stroke.min_x), max(x1, stroke.max_x)
+                symbol[2].append(stroke)
+                continue
+        symbols.append([stroke.min_x, stroke.max_x, [stroke]])
+    # Strokes within a symbol in drawing order
+    return [[list(s.points) for s in sorted(symbol[2], key=lambda s: s.order)] for symbol in symbols]
+
+
+def too_much_ink(strokes):
+    return len(strokes) > MAX_SOLVE_STROKES or sum(len(s.points) for s in strokes) > MAX_SOLVE_POINTS
+
+
+def region_rect(region):
+    return (min(s.min_x for s in region), min(s.min_y for s in region),
+            max(s.max_x for s in region), max(s.max_y for s in region))
+
+
+def content_key(symbols, rect):
+    """Hash of a region's strokes relative to its corner; equal ink, equal key."""
+    digest = hashlib.sha1()
+    x0, y0 = rect[0], rect[1]
+    for symbol in symbols:
+        for stroke in symbol:
+            digest.update(struct.pack("<I", len(stroke)))
+            for x, y in stroke:
+                digest.update(struct.pack("<dd", round(x - x0, 5), round(y - y0, 5)))
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+def evaluate(text):
+    """Value of an arithmetic expression such as ``12+3*4=``; raises ValueError."""
+    # "007" is a number to a writer but a syntax error to Python
+    expression = re.sub(r"(?<![\d.])0+(?=\d)", "", text.split("=")[0])
+    if not expression or len(expression) > MAX_EXPRESSION:
+        raise ValueError("no expression")
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        raise ValueError("not an expression")
+
+    def value(node):
+        if isinstance(node, ast.Expression):
+            return value(node.body)
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in operators:
+            try:
+                return operators[type(node.op)](value(node.left), value(node.right))
+            except ZeroDivisionError:
+                raise ValueError("division by zero")
+        if isinstance(node, ast.UnaryOp) and type(node.op) in operators:
+            return operators[type(node.op)](value(node.operand))
+        raise ValueError("unsupported expression")
+
+    return format_number(value(tree))
+
+
+def format_number(number):
+    if isinstance(number, float) and number.is_integer() and abs(number) < 1e15:
+        number = int(number)
+    if isinstance(number, int):
+        return str(number)
+    return "%.6g" % number
+
+
+class ResultCache:
+    """Least-recently-used map of region content key to recognized text."""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        text = self.entries.get(key)
+        if text is not None:
+            self.entries.move_to_end(key)
+        return text
+
+    def put(self, key, text):
+        self.entries[key] = text
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
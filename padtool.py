@@ -0,0 +1,400 @@
+"""Offline processing of saved pages, stroke logs and the relay's WAL.
+
+    python padtool.py convert data/pages --out export --to svg --simplify 0.0005
+    python padtool.py convert old_saves --out migrated --to png
+    python padtool.py wal data/wal --out board.ndjson
+
+``convert`` walks files and directories and sends every page through
+decode -> simplify -> render/convert -> write, one page per task in a
+process pool. Inputs are PNG pages, NDJSON stroke logs, and legacy saves:
+a file holding a ``data:image/png;base64,...`` URL, the old ``/save`` body
+``{"data": url}``, or a JSON object of page id to URL. Outputs mirror the
+input tree under ``--out``; PNG pages cannot become vectors, so with
+``--to svg`` or ``--to ndjson`` they are written as PNG. Stroke logs are
+rendered fitted to their ink. Only a few pages per worker are in flight at
+once, and each is streamed, legacy dumps included, so memory stays flat
+however many pages there are.
+
+``wal`` replays a relay log directory without touching it and writes the
+visible board as a stroke log in board units, or renders it fitted to the
+page.
+"""
+import argparse
+import base64
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from board import Board, simplify
+from pages import PngValidator, InvalidPage, CHUNK_SIZE
+from render import polylines, read_segments, write_lines
+
+input_kinds = {".png": "png", ".ndjson": "strokes", ".json": "dataurl", ".txt": "dataurl"}
+output_formats = ("png", "svg", "pdf", "ndjson")
+IN_FLIGHT_PER_WORKER = 4
+MAX_KEY = 64
+page_key_pattern = re.compile(r"^[0-9A-Za-z_-]{1,64}$")
+
+
+def find_inputs(paths):
+    """``(path, root)`` for every page under ``paths``, root being what outputs mirror."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path, os.path.dirname(path)
+            continue
+        for directory, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith((".thumb.png", ".tmp", ".part")):
+                    continue
+                if os.path.splitext(name)[1] in input_kinds:
+                    yield os.path.join(directory, name), path
+
+
+def output_path(src, root, out_dir, fmt, suffix=""):
+    relative = os.path.splitext(os.path.relpath(src, root))[0]
+    path = os.path.join(out_dir, relative + suffix + "." + fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def copy_png(src, dst_path):
+    """Stream a PNG to ``dst_path``, checking it on the way; returns its size."""
+    validator = PngValidator()
+    size = 0
+    tmp_path = dst_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as dst:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                validator.feed(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+        validator.close()
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, dst_path)
+    return size
+
+
+def raster_format(fmt):
+    return "pdf" if fmt == "pdf" else "png"
+
+
+def convert_png(src_path, dst_path, fmt, width, height):
+    if fmt == "pdf":
+        from PIL import Image
+
+        with Image.open(src_path) as image:
+            if width and height:
+                image.thumbnail((width, height))
+            image.convert("RGB").save(dst_path, "PDF", resolution=96)
+    else:
+        with open(src_path, "rb") as src:
+            copy_png(src, dst_path)
+
+
+def convert_strokes(src_path, dst_path, fmt, width, height, tolerance):
+    """Returns ``(segments in, segments out)``."""
+    lines = polylines(read_segments(src_path))
+    segments_in = sum(len(points) - 1 for _, _, points in lines)
+    if tolerance:
+        lines = [(color, erasing, simplify(points, tolerance)) for color, erasing, points in lines]
+    segments_out = sum(len(points) - 1 for _, _, points in lines)
+    if fmt == "ndjson":
+        write_stroke_log(lines, dst_path)
+    else:
+        write_lines(lines, dst_path, fmt, width, height)
+    return segments_in, segments_out
+
+
+def write_stroke_log(lines, dst_path):
+    tmp_path = dst_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for color, erasing, points in lines:
+            for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                f.write(json.dumps({"lastX": x0, "lastY": y0, "x": x1, "y": y1,
+                                    "erasing": erasing, "color": color}) + "\n")
+    os.replace(tmp_path, dst_path)
+
+
+class LegacySave:
+    """Streams the pages out of a legacy save without loading the file.
+
+    Iterating yields ``(suffix, reader)`` per page, where ``reader.read``
+    returns decoded PNG bytes. Each reader must be read to the end before
+    the next page is taken.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+
+    def fill(self):
+        """False at the end of the file."""
+        if self.pos < len(self.buf):
+            return True
+        self.buf, self.pos = self.f.read(CHUNK_SIZE), 0
+        return bool(self.buf)
+
+    def char(self):
+        if not self.fill():
+            return ""
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    def skip_space(self):
+        c = self.char()
+        while c.isspace():
+            c = self.char()
+        return c
+
+    def until(self, end, limit):
+        """A short run of characters up to ``end``, such as a key."""
+        out = []
+        c = self.char()
+        while c != end:
+            if not c or len(out) >= limit:
+                raise InvalidPage("malformed legacy save")
+            if c == "\\":
+                c = self.char()
+            out.append(c)
+            c = self.char()
+        return "".join(out)
+
+    def page(self, quoted):
+        if self.until(",", MAX_KEY) != "data:image/png;base64":
+            raise InvalidPage("unsupported data URL")
+        return LegacyPage(self, quoted)
+
+    def __iter__(self):
+        c = self.skip_space()
+        if c == "d":
+            # A bare data URL
+            self.pos -= 1
+            yield "", self.page(quoted=False)
+            return
+        if c != "{":
+            raise InvalidPage("not a data URL or JSON")
+        # The old /save body {"data": url}, or a dump of page id to url
+        c = self.skip_space()
+        while c != "}":
+            if c != '"':
+                raise InvalidPage("malformed legacy save")
+            key = self.until('"', MAX_KEY)
+            if self.skip_space() != ":" or self.skip_space() != '"':
+                raise InvalidPage("unrecognized legacy save")
+            if key == "data":
+                yield "", self.page(quoted=True)
+            elif page_key_pattern.match(key):
+                yield "-" + key, self.page(quoted=True)
+            else:
+                raise InvalidPage("bad page id %r" % key)
+            c = self.skip_space()
+            if c == ",":
+                c = self.skip_space()
+            elif c != "}":
+                raise InvalidPage("malformed legacy save")
+
+
+class LegacyPage:
+    """File-like reader decoding one base64 payload of a LegacySave."""
+
+    def __init__(self, save, quoted):
+        self.save = save
+        self.quoted = quoted
+        self.done = False
+        self.carry = ""
+
+    def read(self, size):
+        want = max(4, size // 3 * 4)
+        data = b""
+        while not data and not self.done:
+            parts = [self.carry]
+            count = len(self.carry)
+            save = self.save
+            while count < want:
+                if not save.fill():
+                    if self.quoted:
+                        raise InvalidPage("truncated legacy save")
+                    self.done = True
+                    break
+                piece = save.buf[save.pos:save.pos + want - count]
+                end = piece.find('"') if self.quoted else -1
+                if end >= 0:
+                    piece = piece[:end]
+                    save.pos += end + 1
+                    self.done = True
+                else:
+                    save.pos += len(piece)
+                parts.append(piece)
+                count += len(piece)
+                if self.done:
+                    break
+            text = "".join(parts)
+            if not self.done and text.endswith("\\"):
+                text, self.carry = text[:-1], "\\"  # an escape split across reads
+            else:
+                self.carry = ""
+            # JSON may escape "/" and wrap lines; base64 itself has no spaces.
+            text = "".join(text.replace("\\/", "/").replace("\\n", "").replace("\\r", "").split())
+            if not self.done:
+                whole = len(text) - len(text) % 4
+                text, self.carry = text[:whole], text[whole:] + self.carry
+            try:
+                data = base64.b64decode(text, validate=True)
+            except ValueError:
+                raise InvalidPage("bad base64 in data URL")
+        return data
+
+
+def convert_legacy(src_path, root, out_dir, fmt, width, height):
+    fmt = raster_format(fmt)
+    outputs = []
+    with open(src_path) as f:
+        for suffix, reader in LegacySave(f):
+            png_path = output_path(src_path, root, out_dir, "png", suffix)
+            copy_png(reader, png_path)
+            if fmt != "png":
+                dst_path = output_path(src_path, root, out_dir, fmt, suffix)
+                convert_png(png_path, dst_path, fmt, width, height)
+                os.remove(png_path)
+                png_path = dst_path
+            outputs.append(png_path)
+    return outputs
+
+
+def process(src_path, root, out_dir, fmt, width, height, tolerance):
+    """Worker entry point: one input file through the pipeline.
+
+    Returns a stats dict; failures are reported in it rather than raised,
+    so one bad page never stops a batch.
+    """
+    stats = {"src": src_path, "bytes_in": 0, "bytes_out": 0, "segments_in": 0, "segments_out": 0, "error": None}
+    try:
+        stats["bytes_in"] = os.path.getsize(src_path)
+        kind = input_kinds[os.path.splitext(src_path)[1]]
+        if kind == "dataurl":
+            outputs = convert_legacy(src_path, root, out_dir, fmt, width, height)
+        else:
+            if kind == "png":
+                dst_path = output_path(src_path, root, out_dir, raster_format(fmt))
+                convert_png(src_path, dst_path, fmt, width, height)
+            else:
+                dst_path = output_path(src_path, root, out_dir, fmt)
+                stats["segments_in"], stats["segments_out"] = convert_strokes(
+                    src_path, dst_path, fmt, width, height, tolerance)
+            outputs = [dst_path]
+        stats["bytes_out"] = sum(os.path.getsize(path) for path in outputs)
+    except Exception as e:  # bad input of any shape; the batch goes on
+        stats["error"] = "%s: %s" % (type(e).__name__, e)
+    return stats
+
+
+def run(paths, out_dir, fmt, width, height, tolerance=0.0, workers=None, report=None):
+    """Convert everything under ``paths``; returns the totals.
+
+    At most ``IN_FLIGHT_PER_WORKER`` tasks per worker are queued at a time.
+    """
+    workers = workers or os.cpu_count() or 1
+    totals = {"files": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0, "segments_in": 0, "segments_out": 0}
+    inputs = find_inputs(paths)
+    pending = set()
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            while len(pending) < workers * IN_FLIGHT_PER_WORKER:
+                item = next(inputs, None)
+                if item is None:
+                    break
+                pending.add(pool.submit(process, item[0], item[1], out_dir, fmt, width, height, tolerance))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stats = future.result()
+                totals["files"] += 1
+                totals["errors"] += stats["error"] is not None
+                for key in ("bytes_in", "bytes_out", "segments_in", "segments_out"):
+                    totals[key] += stats[key]
+                if report is not None:
+                    report(stats)
+    return totals
+
+
+def board_lines(board):
+    """Visible board strokes as ``polylines``-style tuples, in board units."""
+    return [(s.color, s.erasing, s.points) for s in board.strokes.values() if not s.hidden and s.points]
+
+
+def command_convert(args):
+    started = time.perf_counter()
+
+    def report(stats):
+        if stats["error"]:
+            print("%s: %s" % (stats["src"], stats["error"]), file=sys.stderr)
+        elif args.verbose:
+            print(stats["src"])
+
+    totals = run(args.paths, args.out, args.to, args.width, args.height, args.simplify, args.workers, report)
+    elapsed = time.perf_counter() - started
+    print("%d files (%d failed) in %.1fs: %.1f files/s, %.1f MB/s in, %d -> %d segments" % (
+        totals["files"], totals["errors"], elapsed, totals["files"] / elapsed,
+        totals["bytes_in"] / 1e6 / elapsed, totals["segments_in"], totals["segments_out"]))
+    return 1 if totals["errors"] else 0
+
+
+def command_wal(args):
+    from wal import replay
+
+    board = Board(cell_size=None)
+    # User and page records are for the relay; Board.apply ignores them.
+    records = replay(args.directory, lambda state: board.restore(state["board"]), board.apply)
+    lines = board_lines(board)
+    if args.simplify:
+        lines = [(color, erasing, simplify(points, args.simplify)) for color, erasing, points in lines]
+    if args.to == "ndjson":
+        write_stroke_log(lines, args.out)
+    elif lines:
+        write_lines(lines, args.out, args.to, args.width, args.height)
+    print("%d records replayed, %d visible strokes written to %s" % (records, len(lines), args.out))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("convert", help="convert, simplify, render or migrate pages in bulk")
+    p.add_argument("paths", nargs="+", help="page files or directories to walk")
+    p.add_argument("--out", required=True, help="output directory")
+    p.add_argument("--to", choices=output_formats, default="png")
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--simplify", type=float, default=0.0,
+                   help="Douglas-Peucker tolerance for stroke logs, in board units")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--verbose", action="store_true")
+    p.set_defaults(run=command_convert)
+
+    p = sub.add_parser("wal", help="export the board recorded in a relay WAL directory")
+    p.add_argument("directory")
+    p.add_argument("--out", required=True, help="output file")
+    p.add_argument("--to", choices=output_formats, default="ndjson")
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1920)
+    p.add_argument("--simplify", type=float, default=0.0, help="Douglas-Peucker tolerance in board units")
+    p.set_defaults(run=command_wal)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+"""On-disk storage for saved pages.
+
+Page bodies are streamed to disk in chunks and validated as they arrive, so
+a save never holds the whole upload in memory. Two kinds of page exist:
+"png" (a canvas snapshot) and "strokes" (newline-delimited JSON draw
+segments, the same dicts the relay broadcasts).
+"""
+import base64
+import hashlib
+import json
+import math
+import os
+import re
+import struct
+import time
+import uuid
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+MAX_PNG_CHUNK = 2 ** 31 - 1
+MAX_STROKE_LINE = 64 * 1024
+MAX_PAGE_SIZE = 64 * 2 ** 20
+THUMBNAIL_SIZE = (240, 160)
+
+kinds = {
+    "png": {"extension": ".png", "mimetype": "image/png"},
+    "strokes": {"extension": ".ndjson", "mimetype": "application/x-ndjson"},
+}
+mimetype_kinds = {info["mimetype"]: kind for kind, info in kinds.items()}
+
+id_pattern = re.compile(r"^[0-9a-f]{8,32}$")
+
+
+class InvalidPage(ValueError):
+    pass
+
+
+class PageTooLarge(InvalidPage):
+    pass
+
+
+class UploadConflict(Exception):
+    def __init__(self, offset):
+        super().__init__("upload is at offset %d" % offset)
+        self.offset = offset
+
+
+class PngValidator:
+    """Checks PNG structure and chunk CRCs incrementally.
+
+    Only the few bytes of a chunk header are ever buffered; chunk data is
+    passed through the CRC and dropped.
+    """
+
+    def __init__(self):
+        self.pending = b""
+        self.signature_ok = False
+        self.chunk_type = None
+        self.remaining = 0
+        self.crc = 0
+        self.ihdr = b""
+        self.finished = False
+        self.width = None
+        self.height = None
+
+    def feed(self, data):
+        data = self.pending + bytes(data)
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if not self.signature_ok:
+                if end - pos < 8:
+                    break
+                if data[pos:pos + 8] != PNG_SIGNATURE:
+                    raise InvalidPage("not a PNG file")
+                self.signature_ok = True
+                pos += 8
+            elif self.chunk_type is None:
+                if self.finished:
+                    raise InvalidPage("data after IEND")
+                if end - pos < 8:
+                    break
+                length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+                if length > MAX_PNG_CHUNK or not chunk_type.isalpha():
+                    raise InvalidPage("corrupt PNG chunk header")
+                if chunk_type == b"IHDR" and length != 13:
+                    raise InvalidPage("bad IHDR chunk")
+                if self.width is None and chunk_type != b"IHDR":
+                    raise InvalidPage("PNG does not start with IHDR")
+                self.chunk_type = chunk_type
+                self.remaining = length
+                self.crc = zlib.crc32(chunk_type)
+                pos += 8
+            elif self.remaining:
+                take = min(self.remaining, end - pos)
+                piece = data[pos:pos + take]
+                self.crc = zlib.crc32(piece, self.crc)
+                if self.chunk_type == b"IHDR":
+                    self.ihdr += piece
+                self.remaining -= take
+                pos += take
+            else:
+                if end - pos < 4:
+                    break
+                (crc,) = struct.unpack(">I", data[pos:pos + 4])
+                if crc != self.crc:
+                    raise InvalidPage("PNG chunk %s has a bad CRC" % self.chunk_type.decode())
+                if self.chunk_type == b"IHDR":
+                    if len(self.ihdr) != 13:
+                        raise InvalidPage("bad IHDR chunk")
+                    self.width, self.height = struct.unpack(">II", self.ihdr[:8])
+                elif self.chunk_type == b"IEND":
+                    self.finished = True
+                self.chunk_type = None
+                pos += 4
+        self.pending = data[pos:]
+
+    def close(self):
+        if not self.finished or self.pending:
+            raise InvalidPage("truncated PNG")
+        return {"width": self.width, "height": self.height}
+
+
+def check_segment(segment):
+    if not isinstance(segment, dict):
+        raise InvalidPage("stroke log entry is not an object")
+    for key in ("lastX", "lastY", "x", "y"):
+        value = segment.get(key)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise InvalidPage("stroke log entry has a bad %r" % key)
+    color = segment.get("color")
+    if color is not None and not isinstance(color, str):
+        raise InvalidPage("stroke log entry has a bad 'color'")
+
+
+class StrokeLogValidator:
+    """Checks a newline-delimited JSON stroke log line by line."""
+
+    def __init__(self):
+        self.pending = b""
+        self.segments = 0
+
+    def feed(self, data):
+        lines = (self.pending + bytes(data)).split(b"\n")
+        self.pending = lines.pop()
+        if len(self.pending) > MAX_STROKE_LINE:
+            raise InvalidPage("stroke log line too long")
+        for line in lines:
+            self.check_line(line)
+
+    def check_line(self, line):
+        if not line.strip():
+            return
+        try:
+            segment = json.loads(line)
+        except ValueError:
+            raise InvalidPage("stroke log line is not JSON")
+        check_segment(segment)
+        self.segments += 1
+
+    def close(self):
+        self.check_line(self.pending)
+        self.pending = b""
+        if not self.segments:
+            raise InvalidPage("empty stroke log")
+        return {"segments": self.segments}
+
+
+validators = {"png": PngValidator, "strokes": StrokeLogValidator}
+
+
+def new_id():
+    return uuid.uuid4().hex[:8]
+
+
+def check_id(value):
+    if not id_pattern.match(value or ""):
+        raise KeyError(value)
+
+
+class PageStore:
+    """Saved pages and in-progress uploads under one directory.
+
+    Layout: ``<root>/pages/<user>/<page_id>.<ext>`` and
+    ``<root>/uploads/<user>/<upload_id>.part``. User directories are named
+    by a hash of the username so any username is a safe path component.
+    """
+
+    def __init__(self, root, chunk_size=CHUNK_SIZE, max_size=MAX_PAGE_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+
+    def user_dir(self, section, username):
+        name = hashlib.sha1(username.encode("utf-8")).hexdigest()[:16]
+        path = os.path.join(self.root, section, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def page_path(self, username, page_id, kind):
+        check_id(page_id)
+        return os.path.join(self.user_dir("pages", username), page_id + kinds[kind]["extension"])
+
+    def upload_path(self, username, upload_id):
+        check_id(upload_id)
+        return os.path.join(self.user_dir("uploads", username), upload_id + ".part")
+
+    def copy_validated(self, src, dst_path, kind):
+        """Copy ``src`` to ``dst_path`` in chunks while validating it."""
+        validator = validators[kind]()
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = dst_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as dst:
+                while True:
+                    chunk = src.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise PageTooLarge("page is larger than %d bytes" % self.max_size)
+                    validator.feed(chunk)
+                    digest.update(chunk)
+                    dst.write(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+            meta = validator.close()
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        meta.update(kind=kind, size=size, sha256=digest.hexdigest(), created=time.time(), thumbnail=False)
+        return meta
+
+    def save_stream(self, username, stream, kind):
+        """Stream a page body into storage. Returns ``(page_id, meta)``."""
+        if kind not in validators:
+            raise InvalidPage("unsupported page type")
+        return self.store_new(username, stream, kind)
+
+    def store_new(self, username, src, kind):
+        """Validate ``src`` into a page under a fresh id. Returns ``(page_id, meta)``."""
+        page_id = self.reserve_id(username, kind)
+        path = self.page_path(username, page_id, kind)
+        try:
+            meta = self.copy_validated(src, path, kind)
+        except BaseException:
+            os.remove(path)
+            raise
+        return page_id, meta
+
+    def reserve_id(self, username, kind):
+        """Pick an id no page of this user has; the empty file created claims it."""
+        while True:
+            page_id = new_id()
+            if any(os.path.exists(self.page_path(username, page_id, other)) for other in kinds if other != kind):
+                continue
+            try:
+                os.close(os.open(self.page_path(username, page_id, kind), os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+            except FileExistsError:
+                continue
+            return page_id
+
+    def save_data_url(self, username, data_url):
+        """Store a legacy ``data:image/png;base64,...`` save."""
+        header, _, payload = data_url.partition(",")
+        if header != "data:image/png;base64":
+            raise InvalidPage("unsupported data URL")
+        decoded = DataUrlReader(payload)
+        return self.save_stream(username, decoded, "png")
+
+    def thumbnail_path(self, username, page_id):
+        check_id(page_id)
+        return os.path.join(self.user_dir("pages", username), page_id + ".thumb.png")
+
+    def render_path(self, content_hash, fmt, width, height):
+        """Cache location of a render; identical content shares one file."""
+        path = os.path.join(self.root, "renders", content_hash[:2])
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, "%s-%dx%d.%s" % (content_hash, width, height, fmt))
+
+    def open_page(self, username, page_id, kind):
+        return open(self.page_path(username, page_id, kind), "rb")
+
+    def create_upload(self, username):
+        upload_id = uuid.uuid4().hex
+        open(self.upload_path(username, upload_id), "wb").close()
+        return upload_id
+
+    def upload_offset(self, username, upload_id):
+        return os.path.getsize(self.upload_path(username, upload_id))
+
+    def append_upload(self, username, upload_id, offset, stream):
+        """Append a chunk at ``offset``; a mismatch means the client must resume.
+
+        A chunk that would take the upload past ``max_size`` is discarded
+        and raises PageTooLarge.
+        """
+        path = self.upload_path(username, upload_id)
+        current = os.path.getsize(path)
+        if offset != current:
+            raise UploadConflict(current)
+        with open(path, "ab") as f:
+            while True:
+                chunk = stream.read(self.chunk_size)
+                if not chunk:
+                    break
+                if f.tell() + len(chunk) > self.max_size:
+                    f.truncate(current)
+                    raise PageTooLarge("page is larger than %d bytes" % self.max_size)
+                f.write(chunk)
+            return f.tell()
+
+    def finish_upload(self, username, upload_id, kind):
+        if kind not in validators:
+            raise InvalidPage("unsupported page type")
+        path = self.upload_path(username, upload_id)
+        with open(path, "rb") as src:
+            page_id, meta = self.store_new(username, src, kind)
+        os.remove(path)
+        return page_id, meta
+
+
+class DataUrlReader:
+    """File-like reader that base64-decodes a data URL payload in chunks."""
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.pos = 0
+
+    def read(self, size):
+        # Base64 decodes in 4-character groups to 3 bytes.
+        count = max(4, size // 3 * 4)
+        piece = self.payload[self.pos:self.pos + count]
+        self.pos += count
+        try:
+            return base64.b64decode(piece, validate=True)
+        except ValueError:
+            raise InvalidPage("bad base64 in data URL")
+
+
+class PageIndex:
+    """One user's saved pages in save order, for paginated listing.
+
+    Only metadata is held here; listing never opens a page body.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.order = []
+
+    def __contains__(self, page_id):
+        return page_id in self.pages
+
+    def __len__(self):
+        return len(self.order)
+
+    def get(self, page_id, default=None):
+        return self.pages.get(page_id, default)
+
+    def add(self, page_id, meta):
+        if page_id in self.pages:
+            raise ValueError("page %s is already indexed" % page_id)
+        self.pages[page_id] = meta
+        self.order.append(page_id)
+
+    def listing(self, offset=0, limit=50):
+        """Newest-first slice of the index; costs O(limit) whatever its size."""
+        end = max(0, len(self.order) - offset)
+        start = max(0, end - limit)
+        return [dict(self.pages[page_id], id=page_id) for page_id in reversed(self.order[start:end])]
+
+
+def make_thumbnail(src_path, dst_path, size=THUMBNAIL_SIZE):
+    """Write a small PNG preview of a stored PNG page.
+
+    Runs in a worker process; Pillow is only imported there.
+    """
+    from PIL import Image
+
+    with Image.open(src_path) as image:
+        image.draft("RGBA", size)
+        image.thumbnail(size)
+        tmp_path = dst_path + ".tmp"
+        image.save(tmp_path, "PNG", optimize=True)
+    os.replace(tmp_path, dst_path)
+    return dst_path
@@ -1,7 +1,14 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout
-from PyQt5.QtCore import Qt, QPoint
-from PyQt5.QtGui import QPainter, QPen, QPixmap, QColor
+from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QShortcut
+from PyQt5.QtCore import Qt, QPoint, QPointF, QRect
+from PyQt5.QtGui import QPainter, QPen, QPixmap, QColor, QKeySequence, QPolygonF
+
+from board import Stroke, BOARD_UNIT, lod_level
+from profiling import Profiler
+
+PEN_WIDTH = 5
+MIN_SCALE = 0.01
+MAX_SCALE = 100
 
 
 class TransparentDrawingOverlay(QWidget):
@@ -20,13 +27,24 @@ class TransparentDrawingOverlay(QWidget):
         self.last_point = QPoint()
         self.eraser_mode = False  
 
+        # ✅ Stroke History for Undo/Redo
+        self.strokes = []
+        self.redo_stack = []
+        self.current_stroke = None
+
+        # ✅ Pan/Zoom View (strokes are kept in board units)
+        self.view_x = 0.0
+        self.view_y = 0.0
+        self.scale = 1.0
+        self.pan_from = None
+
         # ✅ Create Transparent Canvas
         self.canvas = QPixmap(self.size())
         self.canvas.fill(Qt.transparent)
 
         # ✅ Add Floating Control Buttons
         self.control_panel = QWidget(self)
-        self.control_panel.setGeometry(20, 20, 220, 120)
+        self.control_panel.setGeometry(20, 20, 220, 240)
         layout = QVBoxLayout()
 
         self.toggle_btn = QPushButton("Stop Drawing", self)
@@ -41,8 +59,27 @@ class TransparentDrawingOverlay(QWidget):
         self.clear_btn.clicked.connect(self.clear_canvas)
         layout.addWidget(self.clear_btn)
 
+        self.undo_btn = QPushButton("Undo", self)
+        self.undo_btn.clicked.connect(self.undo)
+        layout.addWidget(self.undo_btn)
+
+        self.redo_btn = QPushButton("Redo", self)
+        self.redo_btn.clicked.connect(self.redo)
+        layout.addWidget(self.redo_btn)
+
+        self.reset_view_btn = QPushButton("Reset View", self)
+        self.reset_view_btn.clicked.connect(self.reset_view)
+        layout.addWidget(self.reset_view_btn)
+
         self.control_panel.setLayout(layout)
 
+        QShortcut(QKeySequence.Undo, self, self.undo)
+        QShortcut(QKeySequence.Redo, self, self.redo)
+
+        # ✅ Profiling mode (PAD_PROFILE, see profiling.py)
+        self.profiler = Profiler.from_env()
+        self.profiler.install(self)
+
     def toggle_overlay(self):
         """Toggles overlay visibility"""
         if self.isVisible():
@@ -60,26 +97,114 @@ class TransparentDrawingOverlay(QWidget):
     def clear_canvas(self):
         """Clears the entire canvas"""
         self.canvas.fill(Qt.transparent)
+        self.strokes.clear()
+        self.redo_stack.clear()
         self.update()
 
+    def pen_for(self, stroke):
+        """Pen used for a stroke"""
+        return QPen(Qt.white if stroke.erasing else Qt.black, PEN_WIDTH * self.scale,
+                    Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
+
+    def to_board(self, pos):
+        """Screen position to board units"""
+        return (pos.x() / (self.scale * BOARD_UNIT) + self.view_x, pos.y() / (self.scale * BOARD_UNIT) + self.view_y)
+
+    def to_screen(self, x, y):
+        """Board units to screen position"""
+        return QPointF((x - self.view_x) * self.scale * BOARD_UNIT, (y - self.view_y) * self.scale * BOARD_UNIT)
+
+    def stroke_rect(self, stroke):
+        """Pixel area covered by a stroke"""
+        pad = int(PEN_WIDTH * self.scale) + 2
+        top_left = self.to_screen(stroke.min_x, stroke.min_y)
+        bottom_right = self.to_screen(stroke.max_x, stroke.max_y)
+        return QRect(int(top_left.x()) - pad, int(top_left.y()) - pad,
+                     int(bottom_right.x() - top_left.x()) + 2 * pad, int(bottom_right.y() - top_left.y()) + 2 * pad)
+
+    def recomposite(self, rect):
+        """Redraws only the strokes that touch rect"""
+        pad = int(PEN_WIDTH * self.scale) + 2
+        area = self.to_board(rect.topLeft() - QPoint(pad, pad)) + self.to_board(rect.bottomRight() + QPoint(pad, pad))
+        level = lod_level(self.scale)
+        with self.profiler.span("recomposite"):
+            painter = QPainter(self.canvas)
+            painter.setClipRect(rect)
+            painter.setCompositionMode(QPainter.CompositionMode_Source)
+            painter.fillRect(rect, Qt.transparent)
+            painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+            for stroke in self.strokes:
+                if not stroke.hidden and stroke.intersects(area):
+                    painter.setPen(self.pen_for(stroke))
+                    painter.drawPolyline(QPolygonF([self.to_screen(x, y) for x, y in stroke.lod_points(level)]))
+            painter.end()
+        self.update(rect)
+
+    def reset_view(self):
+        """Returns to the starting pan and zoom"""
+        self.view_x = self.view_y = 0.0
+        self.scale = 1.0
+        self.recomposite(self.rect())
+
+    def wheelEvent(self, event):
+        """Zooms around the cursor"""
+        anchor_x, anchor_y = self.to_board(event.pos())
+        self.scale = min(MAX_SCALE, max(MIN_SCALE, self.scale * 1.0015 ** event.angleDelta().y()))
+        self.view_x = anchor_x - event.pos().x() / (self.scale * BOARD_UNIT)
+        self.view_y = anchor_y - event.pos().y() / (self.scale * BOARD_UNIT)
+        self.recomposite(self.rect())
+
+    def undo(self):
+        """Hides the last visible stroke"""
+        for stroke in reversed(self.strokes):
+            if not stroke.hidden:
+                stroke.hidden = True
+                self.redo_stack.append(stroke)
+                self.recomposite(self.stroke_rect(stroke))
+                return
+
+    def redo(self):
+        """Restores the last undone stroke"""
+        if self.redo_stack:
+            stroke = self.redo_stack.pop()
+            stroke.hidden = False
+            self.recomposite(self.stroke_rect(stroke))
+
     def paintEvent(self, event):
         """Paint event to render the drawing"""
-        painter = QPainter(self)
-        painter.drawPixmap(0, 0, self.canvas)
+        self.profiler.count("frames")
+        with self.profiler.span("paint"):
+            painter = QPainter(self)
+            painter.drawPixmap(0, 0, self.canvas)
+            painter.end()
 
     def mousePressEvent(self, event):
         """Start drawing on mouse press"""
         if event.button() == Qt.LeftButton:
             self.drawing = True
             self.last_point = event.pos()
+            self.current_stroke = Stroke(len(self.strokes), erasing=self.eraser_mode)
+            self.current_stroke.add_point(*self.to_board(event.pos()))
+            self.strokes.append(self.current_stroke)
+            self.redo_stack.clear()
+        elif event.button() in (Qt.RightButton, Qt.MiddleButton):
+            self.pan_from = event.pos()
 
     def mouseMoveEvent(self, event):
         """Draw as the mouse moves"""
-        if self.drawing:
+        self.profiler.count("received")
+        if self.pan_from is not None:
+            delta = event.pos() - self.pan_from
+            self.pan_from = event.pos()
+            self.view_x -= delta.x() / (self.scale * BOARD_UNIT)
+            self.view_y -= delta.y() / (self.scale * BOARD_UNIT)
+            self.recomposite(self.rect())
+        elif self.drawing:
+            self.profiler.count("processed")
             painter = QPainter(self.canvas)
-            pen = QPen(Qt.black if not self.eraser_mode else Qt.white, 5, Qt.SolidLine, Qt.RoundCap, Qt.RoundJoin)
-            painter.setPen(pen)
+            painter.setPen(self.pen_for(self.current_stroke))
             painter.drawLine(self.last_point, event.pos())
+            self.current_stroke.add_point(*self.to_board(event.pos()))
             self.last_point = event.pos()
             self.update()
 
@@ -87,6 +212,8 @@ class TransparentDrawingOverlay(QWidget):
         """Stop drawing on mouse release"""
         if event.button() == Qt.LeftButton:
             self.drawing = False
+        else:
+            self.pan_from = None
 
 
 if __name__ == "__main__":
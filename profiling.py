@@ -0,0 +1,177 @@
+"""Profiling mode for the Qt clients.
+
+Set PAD_PROFILE to a file name to record a Chrome trace (load it in
+chrome://tracing or https://ui.perfetto.dev) of:
+
+- every paint and recomposite, as timed slices
+- events received and processed per second, and frames per second
+- event-loop stalls: gaps in a 10 ms heartbeat timer longer than
+  PAD_PROFILE_STALL_MS (default 50)
+
+While profiling, Ctrl+Shift+P (or SIGUSR1) starts and stops a cProfile
+capture, written next to the trace as ``<trace>.<n>.prof``, and
+Ctrl+Shift+M starts and stops tracemalloc, writing the top allocation
+sites to ``<trace>.<n>.mem.txt``. The trace is written when the app quits.
+"""
+import contextlib
+import json
+import os
+import signal
+import threading
+import time
+
+from PyQt5.QtCore import QTimer
+from PyQt5.QtGui import QKeySequence
+from PyQt5.QtWidgets import QApplication, QShortcut
+
+HEARTBEAT_INTERVAL = 10  # ms
+MAX_EVENTS = 1000000
+TOP_ALLOCATIONS = 25
+
+
+class Span:
+    __slots__ = ("profiler", "name", "cat", "start")
+
+    def __init__(self, profiler, name, cat):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.complete(self.name, self.cat, self.start, time.perf_counter())
+
+
+class Profiler:
+    """Collects trace events; every method is a no-op when ``path`` is None."""
+
+    def __init__(self, path=None, stall_threshold=0.05):
+        self.path = path
+        self.enabled = path is not None
+        self.stall_threshold = stall_threshold
+        self.started = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.dropped = 0
+        self.counts = {}  # counter name: events since the last report
+        # count() is also called from the Socket.IO thread
+        self.counts_lock = threading.Lock()
+        self.captures = 0
+        self.cprofile = None
+        self.last_beat = None
+        self.null_span = contextlib.nullcontext()
+
+    @classmethod
+    def from_env(cls):
+        path = os.environ.get("PAD_PROFILE")
+        return cls(path, float(os.environ.get("PAD_PROFILE_STALL_MS", 50)) / 1000)
+
+    def timestamp(self, t):
+        return (t - self.started) * 1e6
+
+    def add(self, event):
+        if len(self.events) < MAX_EVENTS:
+            event["pid"] = self.pid
+            self.events.append(event)
+        else:
+            self.dropped += 1
+
+    def span(self, name, cat="paint"):
+        """Context manager timing one slice of work."""
+        if not self.enabled:
+            return self.null_span
+        return Span(self, name, cat)
+
+    def complete(self, name, cat, start, end):
+        self.add({"name": name, "cat": cat, "ph": "X", "ts": self.timestamp(start),
+                  "dur": (end - start) * 1e6, "tid": threading.get_ident()})
+
+    def instant(self, name, **args):
+        self.add({"name": name, "ph": "i", "s": "p", "ts": self.timestamp(time.perf_counter()),
+                  "tid": threading.get_ident(), "args": args})
+
+    def count(self, name):
+        """Count one event, from any thread; totals are reported once a second."""
+        if self.enabled:
+            with self.counts_lock:
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def install(self, widget):
+        """Start the timers, hotkeys and signal handler, and write the trace on quit."""
+        if not self.enabled:
+            return
+        self.heartbeat = QTimer(widget)
+        self.heartbeat.setInterval(HEARTBEAT_INTERVAL)
+        self.heartbeat.timeout.connect(self.beat)
+        self.heartbeat.start()
+        self.reporter = QTimer(widget)
+        self.reporter.setInterval(1000)
+        self.reporter.timeout.connect(self.report)
+        self.reporter.start()
+        QShortcut(QKeySequence("Ctrl+Shift+P"), widget, self.toggle_cprofile)
+        QShortcut(QKeySequence("Ctrl+Shift+M"), widget, self.toggle_tracemalloc)
+        if hasattr(signal, "SIGUSR1"):
+            # Python runs signal handlers between bytecodes; the heartbeat
+            # keeps bytecodes running while Qt waits for events.
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_cprofile())
+        QApplication.instance().aboutToQuit.connect(self.write)
+
+    def beat(self):
+        now = time.perf_counter()
+        if self.last_beat is not None:
+            late = now - self.last_beat - HEARTBEAT_INTERVAL / 1000
+            if late > self.stall_threshold:
+                self.complete("stall", "event loop", self.last_beat + HEARTBEAT_INTERVAL / 1000, now)
+        self.last_beat = now
+
+    def report(self):
+        with self.counts_lock:
+            counts, self.counts = self.counts, {}
+        ts = self.timestamp(time.perf_counter())
+        for name, value in counts.items():
+            self.add({"name": name + "/s", "ph": "C", "ts": ts, "tid": 0, "args": {name: value}})
+
+    def capture_path(self, suffix):
+        return "%s.%d.%s" % (self.path, self.captures, suffix)
+
+    def toggle_cprofile(self):
+        if self.cprofile is None:
+            import cProfile
+
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+            self.instant("cProfile start")
+            return
+        self.cprofile.disable()
+        self.captures += 1
+        path = self.capture_path("prof")
+        self.cprofile.dump_stats(path)
+        self.cprofile = None
+        self.instant("cProfile stop", file=path)
+
+    def toggle_tracemalloc(self):
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.instant("tracemalloc start")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.captures += 1
+        path = self.capture_path("mem.txt")
+        with open(path, "w") as f:
+            f.write("current %d bytes, peak %d bytes\n" % (current, peak))
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                f.write("%s\n" % stat)
+        self.instant("tracemalloc stop", file=path, current=current, peak=peak)
+
+    def write(self):
+        if self.cprofile is not None:
+            self.toggle_cprofile()
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms",
+                       "otherData": {"dropped_events": self.dropped}}, f)
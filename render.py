@@ -0,0 +1,148 @@
+"""Headless rendering of stored stroke logs to PNG, SVG and PDF.
+
+Segments are in board units, which are unbounded and may be negative. A
+page is drawn into a view rectangle of the board, by default the bounding
+box of its ink, scaled to fit the output with the aspect ratio kept, so it
+can be rendered at any resolution. Consecutive segments that join up are
+merged into one polyline, which keeps the number of drawing calls per page
+to roughly the number of strokes.
+"""
+import json
+import os
+
+from limits import color_pattern
+
+formats = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+}
+
+# Pen widths of the web pad, in pixels at REFERENCE_WIDTH.
+REFERENCE_WIDTH = 1000
+PEN_WIDTH = 3
+ERASER_WIDTH = 20
+# Renders are cached per (width, height), so the server only renders sizes
+# from this list, and never more than MAX_PIXELS in total.
+SIZES = (256, 512, 720, 1080, 1280, 1440, 1920, 2160, 2560, 3840, 4320, 7680)
+MAX_PIXELS = 7680 * 4320
+MARGIN = 0.02  # of the view, on each side
+
+def snap_size(width, height):
+    """The allowed render size closest above ``width`` x ``height``."""
+    def snap(n):
+        return next((size for size in SIZES if size >= n), SIZES[-1])
+
+    width, height = snap(width), snap(height)
+    while width * height > MAX_PIXELS:
+        # Shrink the longer side a step, so the shape stays close
+        if width >= height:
+            width = SIZES[SIZES.index(width) - 1]
+        else:
+            height = SIZES[SIZES.index(height) - 1]
+    return width, height
+
+
+def read_segments(path):
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def polylines(segments):
+    """Merge joined segments into ``(color, erasing, points)`` polylines."""
+    lines = []
+    current = None
+    for seg in segments:
+        color = seg.get("color") or "black"
+        if not isinstance(color, str) or not color_pattern.match(color):
+            color = "black"
+        erasing = bool(seg.get("erasing"))
+        start = (seg["lastX"], seg["lastY"])
+        if current is None or current[0] != color or current[1] != erasing or current[2][-1] != start:
+            current = (color, erasing, [start])
+            lines.append(current)
+        current[2].append((seg["x"], seg["y"]))
+    return lines
+
+
+def pen_width(erasing, width):
+    return max(1, round((ERASER_WIDTH if erasing else PEN_WIDTH) * width / REFERENCE_WIDTH))
+
+
+def ink_bounds(lines):
+    """Bounding box ``(x0, y0, x1, y1)`` of the points in ``lines``, with a margin."""
+    xs = [x for _, _, points in lines for x, _ in points]
+    ys = [y for _, _, points in lines for _, y in points]
+    if not xs:
+        return (0.0, 0.0, 1.0, 1.0)
+    x0, y0, x1, y1 = min(xs), min(ys), max(xs), max(ys)
+    margin = max(x1 - x0, y1 - y0, 1e-6) * MARGIN
+    return (x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+
+
+def to_pixels(lines, width, height, view=None):
+    """Map ``lines`` from board units into a ``width`` x ``height`` image.
+
+    ``view`` is the board rectangle to show, the ink's bounding box if
+    None; it is scaled uniformly and centred.
+    """
+    x0, y0, x1, y1 = view or ink_bounds(lines)
+    scale = min(width / ((x1 - x0) or 1.0), height / ((y1 - y0) or 1.0))
+    dx = (width - (x1 - x0) * scale) / 2 - x0 * scale
+    dy = (height - (y1 - y0) * scale) / 2 - y0 * scale
+    return [(color, erasing, [(x * scale + dx, y * scale + dy) for x, y in points])
+            for color, erasing, points in lines]
+
+
+def rasterize(lines, width, height, view=None):
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for color, erasing, scaled in to_pixels(lines, width, height, view):
+        try:
+            draw.line(scaled, fill="white" if erasing else color, width=pen_width(erasing, width), joint="curve")
+        except ValueError:
+            draw.line(scaled, fill="black", width=pen_width(erasing, width), joint="curve")
+    return image
+
+
+def svg_document(lines, width, height, view=None):
+    parts = [
+        '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">' % (
+            width, height, width, height),
+        '<rect width="100%" height="100%" fill="white"/>',
+    ]
+    for color, erasing, points in to_pixels(lines, width, height, view):
+        coords = " ".join("%.1f,%.1f" % (x, y) for x, y in points)
+        parts.append(
+            '<polyline points="%s" fill="none" stroke="%s" stroke-width="%d" '
+            'stroke-linecap="round" stroke-linejoin="round"/>' % (
+                coords, "white" if erasing else color, pen_width(erasing, width)))
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def render_file(src_path, dst_path, fmt, width, height, view=None):
+    """Render the stroke log at ``src_path`` into ``dst_path``.
+
+    Entry point for the render worker processes; the output is written to
+    a temporary name first so readers never see a partial file.
+    """
+    return write_lines(polylines(read_segments(src_path)), dst_path, fmt, width, height, view)
+
+
+def write_lines(lines, dst_path, fmt, width, height, view=None):
+    """Render ``polylines`` output to ``dst_path``, via a temporary name."""
+    tmp_path = "%s.%d.tmp" % (dst_path, os.getpid())
+    if fmt == "svg":
+        with open(tmp_path, "w") as f:
+            f.write(svg_document(lines, width, height, view))
+    elif fmt == "pdf":
+        rasterize(lines, width, height, view).save(tmp_path, "PDF", resolution=96)
+    else:
+        rasterize(lines, width, height, view).save(tmp_path, "PNG")
+    os.replace(tmp_path, dst_path)
+    return dst_path
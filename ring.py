@@ -0,0 +1,169 @@
+"""Same-host fast path from the relay to viewers: a shared-memory ring.
+
+The relay writes every draw segment it fans out as a fixed-size packed
+record into a ring in ``multiprocessing.shared_memory``; a viewer on the
+same machine polls it instead of receiving ``draw`` events over Socket.IO.
+Everything else (viewport replies, undo/redo) still travels over Socket.IO.
+
+Layout: a header holding the number of records ever written, then
+``capacity`` record slots. Record ``n`` goes to slot ``n % capacity`` and
+carries ``n + 1`` in its first field, written last and cleared first, so a
+reader can tell a slot that is being rewritten from one it can use. A
+reader that falls more than ``capacity`` records behind loses the oldest
+ones and should resync over Socket.IO.
+"""
+import struct
+import threading
+from multiprocessing import shared_memory
+
+MAGIC = b"PADR"
+CAPACITY = 65536
+HEADER = struct.Struct("<4sIQQ")  # magic, record size, capacity, records written
+WRITTEN_OFFSET = 16
+RECORD = struct.Struct("<Q4dQB64s23s64s")  # ring seq, coords, seq, erasing, stroke, color, author
+STAMP = struct.Struct("<Q")
+# The same layout as a NumPy dtype, for readers that have NumPy.
+record_fields = [("ring_seq", "<u8"), ("coords", "<f8", (4,)), ("seq", "<u8"), ("erasing", "u1"),
+                 ("stroke", "S64"), ("color", "S23"), ("author", "S64")]
+
+
+def attach(name):
+    """Open an existing segment without letting this process's resource
+    tracker unlink it at exit; it belongs to the relay."""
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:  # Python < 3.13
+        shm = shared_memory.SharedMemory(name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class RingWriter:
+    def __init__(self, name, capacity=CAPACITY):
+        size = HEADER.size + capacity * RECORD.size
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a relay that did not shut down cleanly
+            stale = attach(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self.capacity = capacity
+        self.written = 0
+        self.lock = threading.Lock()
+        HEADER.pack_into(self.shm.buf, 0, MAGIC, RECORD.size, capacity, 0)
+
+    def write(self, segment, author):
+        coords = (segment["lastX"], segment["lastY"], segment["x"], segment["y"])
+        with self.lock:
+            n = self.written
+            offset = HEADER.size + (n % self.capacity) * RECORD.size
+            buf = self.shm.buf
+            STAMP.pack_into(buf, offset, 0)
+            RECORD.pack_into(buf, offset, 0, *coords, segment.get("seq") or 0, segment["erasing"],
+                             segment["stroke"].encode(), segment["color"].encode(), str(author).encode()[:64])
+            STAMP.pack_into(buf, offset, n + 1)
+            self.written = n + 1
+            STAMP.pack_into(buf, WRITTEN_OFFSET, n + 1)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class RingReader:
+    """Polls a relay's ring. Uses NumPy views over the shared buffer when
+    NumPy is installed and ``struct`` otherwise.
+
+    ``shm`` reads through a segment this process already has open, such as
+    its own writer's.
+    """
+
+    def __init__(self, name, use_numpy=True, shm=None):
+        self.shm = shm or attach(name)
+        magic, record_size, self.capacity, written = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            self.shm.close()
+            raise ValueError("%s is not a stroke ring" % name)
+        self.read = written  # start at the live edge
+        self.lost = 0
+        self.records = None
+        if use_numpy:
+            try:
+                import numpy
+            except ImportError:
+                numpy = None
+            if numpy is not None:
+                self.records = numpy.frombuffer(self.shm.buf, numpy.dtype(record_fields),
+                                                count=self.capacity, offset=HEADER.size)
+
+    def written(self):
+        return STAMP.unpack_from(self.shm.buf, WRITTEN_OFFSET)[0]
+
+    def poll(self, limit=4096):
+        """Draw messages written since the last poll, oldest first.
+
+        ``self.lost`` counts records overwritten before they were read.
+        """
+        head = self.written()
+        if head - self.read > self.capacity:
+            self.lost += head - self.capacity - self.read
+            self.read = head - self.capacity
+        end = min(head, self.read + limit)
+        if self.records is not None:
+            messages = self.poll_numpy(end)
+        else:
+            messages = self.poll_struct(end)
+        return messages
+
+    def poll_struct(self, end):
+        messages = []
+        buf = self.shm.buf
+        for n in range(self.read, end):
+            offset = HEADER.size + (n % self.capacity) * RECORD.size
+            record = RECORD.unpack_from(buf, offset)
+            if record[0] != n + 1 or STAMP.unpack_from(buf, offset)[0] != n + 1:
+                break  # being rewritten: the writer is mid-write or has lapped us
+            messages.append(message(record[1:5], record[5], record[6], record[7], record[8], record[9]))
+        self.read += len(messages)
+        return messages
+
+    def poll_numpy(self, end):
+        messages = []
+        records = self.records
+        n = self.read
+        while n < end:
+            start = n % self.capacity
+            chunk = records[start:start + (end - n)]  # a view; wraps in two steps
+            stamps = chunk["ring_seq"]
+            for i in range(len(chunk)):
+                if stamps[i] != n + 1:
+                    self.read = n  # being rewritten, as in poll_struct
+                    return messages
+                record = chunk[i]
+                data = message(record["coords"].tolist(), int(record["seq"]), record["erasing"],
+                               record["stroke"], record["color"], record["author"])
+                if stamps[i] != n + 1:
+                    self.read = n
+                    return messages
+                messages.append(data)
+                n += 1
+        self.read = n
+        return messages
+
+    def close(self):
+        self.records = None  # release the view, or close() refuses
+        self.shm.close()
+
+
+def message(coords, seq, erasing, stroke, color, author):
+    x0, y0, x1, y1 = coords
+    data = {"lastX": x0, "lastY": y0, "x": x1, "y": y1, "erasing": bool(erasing),
+            "stroke": stroke.rstrip(b"\0").decode("utf-8", "replace"),
+            "color": color.rstrip(b"\0").decode("ascii", "replace"),
+            "author": author.rstrip(b"\0").decode("utf-8", "replace")}
+    if seq:
+        data["seq"] = seq
+    return data
@@ -1,16 +1,260 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session, jsonify
-from flask_socketio import SocketIO, emit
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_file
+from flask_socketio import SocketIO, emit, disconnect, join_room, leave_room
 from flask_cors import CORS
-import uuid
+from werkzeug.security import generate_password_hash, check_password_hash
+import atexit
+import base64
+import json
+import math
+import os
+import threading
+
+from pages import PageStore, PageIndex, InvalidPage, PageTooLarge, UploadConflict, kinds, mimetype_kinds, make_thumbnail, THUMBNAIL_SIZE, MAX_PAGE_SIZE
+from render import render_file, formats as render_formats, snap_size
+from board import Board
+from mathsolve import group_regions, split_symbols, region_rect, content_key, evaluate, recognize_batch, too_much_ink, ResultCache
+from wal import WriteAheadLog, checkpoint_loop
+from limits import RateLimiter, Coalescer, clean_segment, overflow_policies, DRAW_RATE, DRAW_BURST, USER_DRAW_RATE, USER_DRAW_BURST
+
+# engine.io settings per transport profile, selected with PAD_TRANSPORT.
+# "client" is handed to the browser's io() call so both ends agree.
+# http_compression and compression_threshold only apply to polling. Over
+# WebSocket, permessage-deflate is negotiated by the server backend
+# (simple-websocket or eventlet), which accepts it whenever the client
+# offers it, as browsers do. Those backends have no option to turn it off
+# or set a threshold. bench.py transport reports whether it was in use.
+transport_profiles = {
+    "default": {
+        "server": {},
+        "client": {},
+    },
+    "websocket": {
+        "server": {
+            "transports": ["websocket"],
+            "ping_interval": 10,
+            "ping_timeout": 5,
+            "max_http_buffer_size": 16 * 1024 * 1024,
+        },
+        "client": {"transports": ["websocket"]},
+    },
+    "mobile": {
+        "server": {
+            "transports": ["websocket", "polling"],
+            "ping_interval": 15,
+            "ping_timeout": 10,
+            "http_compression": True,
+            "compression_threshold": 256,
+            "max_http_buffer_size": 16 * 1024 * 1024,
+        },
+        "client": {"transports": ["websocket", "polling"]},
+    },
+}
+transport_name = os.environ.get("PAD_TRANSPORT", "default")
+if transport_name not in transport_profiles:
+    raise ValueError("PAD_TRANSPORT must be one of %s" % ", ".join(transport_profiles))
+transport = transport_profiles[transport_name]
 
 app = Flask(__name__)
 app.secret_key = 'secretkey'
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", **transport["server"])
 CORS(app)
 
 # In-memory user store
-users = {}  # username: password
-user_drawings = {}  # username: {page_id: drawing_data}
+users = {}  # username: password hash
+user_drawings = {}  # username: PageIndex of page metadata
+board = Board()  # strokes on the live shared board
+
+# Page bodies live on disk; user_drawings only keeps their metadata.
+data_dir = os.environ.get("PAD_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+store = PageStore(data_dir, max_size=int(os.environ.get("PAD_MAX_PAGE_BYTES", MAX_PAGE_SIZE)))
+
+# Users, page metadata and board strokes are logged to a write-ahead log
+# (see open_wal) and rebuilt from it on startup. Every logged change and
+# every checkpoint takes state_lock, so a snapshot always matches the log
+# segments before it.
+wal = None
+state_lock = board.lock
+
+# Draw events are rate limited per socket and per signed-in user (a rate
+# of 0 disables this). PAD_DRAW_OVERFLOW picks what happens to segments
+# over the limit: "drop" them, "coalesce" them into one segment per stroke
+# that is relayed once tokens free up, or "disconnect" the client.
+draw_limiter = RateLimiter(
+    float(os.environ.get("PAD_DRAW_RATE", DRAW_RATE)),
+    float(os.environ.get("PAD_DRAW_BURST", DRAW_BURST)),
+    float(os.environ.get("PAD_USER_DRAW_RATE", USER_DRAW_RATE)),
+    float(os.environ.get("PAD_USER_DRAW_BURST", USER_DRAW_BURST)),
+)
+overflow_policy = os.environ.get("PAD_DRAW_OVERFLOW", "coalesce")
+if overflow_policy not in overflow_policies:
+    raise ValueError("PAD_DRAW_OVERFLOW must be one of %s" % ", ".join(overflow_policies))
+coalescer = Coalescer()
+COALESCE_INTERVAL = 0.02
+
+
+def journal(record):
+    """Log a change; returns a ticket for wait_durable (None if logging is off)."""
+    if wal is None:
+        return None
+    return wal.append(record)
+
+
+def wait_durable(ticket):
+    if ticket is not None:
+        wal.wait(ticket)
+
+
+def restore_page(username, page_id, meta):
+    meta["thumbnail"] = os.path.exists(store.thumbnail_path(username, page_id))
+    user_drawings.setdefault(username, PageIndex()).add(page_id, meta)
+
+
+def restore_state(state):
+    users.update(state["users"])
+    for username in state["users"]:
+        user_drawings.setdefault(username, PageIndex())
+    for username, pages in state["pages"].items():
+        for page_id, meta in pages:
+            restore_page(username, page_id, meta)
+    board.restore(state["board"])
+
+
+def apply_record(record):
+    if record[0] == "user":
+        users[record[1]] = record[2]
+        user_drawings.setdefault(record[1], PageIndex())
+    elif record[0] == "page":
+        restore_page(record[1], record[2], record[3])
+    else:
+        board.apply(record)
+
+
+def capture_state():
+    return {
+        "users": dict(users),
+        "pages": {username: [[page_id, dict(index.get(page_id))] for page_id in index.order]
+                  for username, index in user_drawings.items()},
+        "board": board.snapshot(),
+    }
+
+
+def open_wal():
+    """Recover state from the log and start logging and checkpointing."""
+    global wal
+    if os.environ.get("PAD_WAL", "1") == "0":
+        return
+    wal = WriteAheadLog(os.path.join(data_dir, "wal"),
+                        flush_interval=float(os.environ.get("PAD_WAL_FLUSH_INTERVAL", 0.01)),
+                        batch_size=int(os.environ.get("PAD_WAL_BATCH", 1024)))
+    wal.recover(restore_state, apply_record)
+    board.journal = journal
+    socketio.start_background_task(
+        checkpoint_loop, wal, state_lock, capture_state,
+        float(os.environ.get("PAD_CHECKPOINT_INTERVAL", 300)),
+        int(os.environ.get("PAD_CHECKPOINT_BYTES", 64 * 2 ** 20)),
+        sleep=socketio.sleep)
+
+# With PAD_SHM_RING set, relayed segments are also written to a shared
+# memory ring of that name for viewers on this machine (see ring.py).
+# Draws are broadcast to DRAW_ROOM, which every client joins on connect; a
+# viewer reading the ring sends "use_ring" to leave it.
+ring = None
+DRAW_ROOM = "draws"
+
+
+def open_ring():
+    global ring
+    name = os.environ.get("PAD_SHM_RING")
+    if not name:
+        return
+    from ring import RingWriter, CAPACITY
+    ring = RingWriter(name, int(os.environ.get("PAD_SHM_RING_SIZE", CAPACITY)))
+    atexit.register(ring.close)
+
+# Thumbnails and renders run in worker processes so they never hold up
+# request threads or the Socket.IO relay.
+worker_pool = None
+renders_in_flight = {}  # output path: Future
+
+
+def get_worker_pool():
+    global worker_pool
+    if worker_pool is None:
+        # Imported here: multiprocessing is not needed until the first render.
+        from concurrent.futures import ProcessPoolExecutor
+        worker_pool = ProcessPoolExecutor(max_workers=int(os.environ.get("PAD_RENDER_WORKERS", os.cpu_count() or 2)))
+    return worker_pool
+
+
+def submit_render(src_path, dst_path, fmt, width, height):
+    """Render in the pool, sharing one job between identical requests."""
+    future = renders_in_flight.get(dst_path)
+    if future is None:
+        future = get_worker_pool().submit(render_file, src_path, dst_path, fmt, width, height)
+        renders_in_flight[dst_path] = future
+        future.add_done_callback(lambda f: renders_in_flight.pop(dst_path, None))
+    return future
+
+
+def add_page(username, page_id, meta):
+    """Index a stored page and render its thumbnail in the background."""
+    with state_lock:
+        user_drawings[username].add(page_id, meta)
+        ticket = journal(["page", username, page_id, meta])
+    wait_durable(ticket)
+    src_path = store.page_path(username, page_id, meta["kind"])
+    dst_path = store.thumbnail_path(username, page_id)
+    if meta["kind"] == "png":
+        future = get_worker_pool().submit(make_thumbnail, src_path, dst_path)
+    else:
+        future = submit_render(src_path, dst_path, "png", *THUMBNAIL_SIZE)
+    future.add_done_callback(lambda f: meta.update(thumbnail=f.exception() is None))
+
+# Handwritten math (see mathsolve.py). Regions waiting for recognition are
+# queued and sent to the worker pool in batches, whoever asked; a region
+# several viewers ask about at once is recognized once, and recognized
+# text is kept by content hash so an unchanged region is never redone.
+math_results = ResultCache()  # region content key: recognized text
+math_waiting = {}  # content key: [(sid, region rect)] waiting for its text
+math_queue = []  # (content key, symbols) not yet sent to a worker
+math_lock = threading.Lock()
+MATH_BATCH_INTERVAL = 0.05
+MATH_BATCH_SIZE = 32
+
+
+def send_result(sid, rect, key, text):
+    try:
+        result, error = evaluate(text), None
+    except ValueError as e:
+        result, error = None, str(e)
+    socketio.emit('display_result', {"key": key, "region": list(rect), "expression": text,
+                                     "result": result, "error": error}, to=sid)
+
+
+def deliver_math(future, batch):
+    try:
+        results = future.result()
+    except Exception:
+        results = [(key, "") for key, _ in batch]  # nothing recognized
+    for key, text in results:
+        with math_lock:
+            if text:
+                math_results.put(key, text)
+            waiters = math_waiting.pop(key, [])
+        for sid, rect in waiters:
+            send_result(sid, rect, key, text)
+
+
+def math_batcher():
+    global math_queue
+    while True:
+        socketio.sleep(MATH_BATCH_INTERVAL)
+        with math_lock:
+            queued, math_queue = math_queue, []
+        for start in range(0, len(queued), MATH_BATCH_SIZE):
+            batch = queued[start:start + MATH_BATCH_SIZE]
+            future = get_worker_pool().submit(recognize_batch, batch)
+            future.add_done_callback(lambda f, batch=batch: deliver_math(f, batch))
 
 html_template = """
 <!DOCTYPE html>
@@ -49,6 +293,26 @@ html_template = """
         }
         #eraserBtn { background: gray; }
         #addCanvasBtn { background: blue; }
+        #pageGallery {
+            position: fixed;
+            inset: 20px 20px 90px 20px;
+            z-index: 1500;
+            background: rgba(255, 255, 255, 0.97);
+            border-radius: 10px;
+            padding: 10px;
+            overflow-y: auto;
+            display: none;
+        }
+        .page-tiles { display: flex; flex-wrap: wrap; gap: 10px; justify-content: center; }
+        .page-tile {
+            width: 240px;
+            cursor: pointer;
+            border: 1px solid #ccc;
+            border-radius: 6px;
+            font-size: 12px;
+            background: #f8f8f8;
+        }
+        .page-tile img { display: block; width: 240px; height: 160px; object-fit: contain; background: white; }
         #toggleMenuBtn {
             position: fixed;
             bottom: 20px;
@@ -81,8 +345,13 @@ html_template = """
     <div id="toggleMenuBtn">☰</div>
     <div class="button-container" id="buttonContainer">
         <button id="eraserBtn">Eraser OFF</button>
+        <button id="panBtn">Pan OFF</button>
         <button id="addCanvasBtn">Add New Canvas</button>
+        <button id="undoBtn">Undo</button>
+        <button id="redoBtn">Redo</button>
+        <button id="solveBtn">Solve</button>
         <button id="saveCanvasBtn">Save Page</button>
+        <button id="myPagesBtn">My Pages</button>
         <button id="logoutBtn">Logout</button>
         <input id="loadPageInput" placeholder="Page ID" />
         <button id="loadPageBtn">Load Page</button>
@@ -94,14 +363,19 @@ html_template = """
             <div style="background: orange;" data-color="orange"></div>
         </div>
     </div>
+    <div id="pageGallery">
+        <div class="page-tiles" id="pageTiles"></div>
+        <button id="morePagesBtn">Load More</button>
+    </div>
     <div class="canvas-container" id="canvasContainer">
         <canvas class="drawingCanvas"></canvas>
     </div>
     <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.4.1/socket.io.js"></script>
     <script>
-        const socket = io();
+        const socket = io({{ socket_options|tojson }});
         const canvasContainer = document.getElementById("canvasContainer");
         const eraserBtn = document.getElementById("eraserBtn");
+        const panBtn = document.getElementById("panBtn");
         const addCanvasBtn = document.getElementById("addCanvasBtn");
         const toggleMenuBtn = document.getElementById("toggleMenuBtn");
         const buttonContainer = document.getElementById("buttonContainer");
@@ -110,101 +384,421 @@ html_template = """
         const loadPageBtn = document.getElementById("loadPageBtn");
         const loadPageInput = document.getElementById("loadPageInput");
         const logoutBtn = document.getElementById("logoutBtn");
-        let canvasList = [];
+        const myPagesBtn = document.getElementById("myPagesBtn");
+        const undoBtn = document.getElementById("undoBtn");
+        const redoBtn = document.getElementById("redoBtn");
+        const solveBtn = document.getElementById("solveBtn");
+        const pageGallery = document.getElementById("pageGallery");
+        const pageTiles = document.getElementById("pageTiles");
+        const morePagesBtn = document.getElementById("morePagesBtn");
+        let nextPageOffset = 0;
         let erasing = false;
         let penColor = "black";
+        let panning = false;
+
+        // The board is unbounded. Points are in board units, BOARD_UNIT
+        // screen pixels at zoom 1, and the view maps them onto the canvas.
+        const BOARD_UNIT = 1000;
+        const MIN_SCALE = 0.01;
+        const MAX_SCALE = 100;
+        const view = { x: 0, y: 0, scale: 1 };
+
+        // 1e-5 board units is a hundredth of a pixel at zoom 1 and keeps
+        // each coordinate to a few characters on the wire.
+        function quantize(v) {
+            return Math.round(v * 100000) / 100000;
+        }
 
-        function createCanvas(sync = true) {
-            const canvas = document.createElement("canvas");
-            canvas.classList.add("drawingCanvas");
-            canvasContainer.appendChild(canvas);
-            setupCanvas(canvas);
+        const clientId = Math.random().toString(36).slice(2, 10);
+        let strokeCounter = 0;
 
-            if (sync) {
-                socket.emit("add_canvas");
-            }
+        function newStrokeId() {
+            return `${clientId}-${++strokeCounter}`;
         }
 
-        function setupCanvas(canvas) {
-            const ctx = canvas.getContext("2d");
+        // Every segment this pad sends is numbered. Segments stay in
+        // `unacked` until the relay confirms them and are sent again after a
+        // reconnect; the relay and viewers drop numbers a stroke already has.
+        // Segments drawn while offline are not emitted (socket.io would
+        // send its buffer before the re-sends) but go out with them, in order.
+        let seq = 0;
+        const unacked = new Map();  // seq: segment
+
+        function sendSegment(segment) {
+            unacked.set(segment.seq, segment);
+            if (socket.connected) socket.emit("draw", segment, () => unacked.delete(segment.seq));
+        }
 
-            function resizeCanvas() {
-                canvas.width = window.innerWidth;
-                canvas.height = window.innerHeight;
-            }
-            resizeCanvas();
-            window.addEventListener("resize", resizeCanvas);
+        const canvas = canvasContainer.querySelector("canvas");
+        const ctx = canvas.getContext("2d");
+        // Strokes on the board, kept so the view can be redrawn after a pan or
+        // zoom and an undone stroke removed by repainting only its area.
+        const strokes = new Map();
+        let pageImage = null;  // loaded page, placed at { x, y } in board units
+
+        function toScreen(x, y) {
+            return [(x - view.x) * view.scale * BOARD_UNIT, (y - view.y) * view.scale * BOARD_UNIT];
+        }
 
-            let drawing = false;
-            let lastX = null, lastY = null;
+        function toBoard(sx, sy) {
+            return [sx / (view.scale * BOARD_UNIT) + view.x, sy / (view.scale * BOARD_UNIT) + view.y];
+        }
+
+        function visibleRect() {
+            const [x0, y0] = toBoard(0, 0);
+            const [x1, y1] = toBoard(canvas.width, canvas.height);
+            return { x0, y0, x1, y1 };
+        }
+
+        function newStroke(color, isEraser, points, lod, seq = 0) {
+            const stroke = {
+                color, erasing: isEraser, hidden: false, points, lod, seq, keys: null,
+                minX: Infinity, minY: Infinity, maxX: -Infinity, maxY: -Infinity
+            };
+            points.forEach(point => growStroke(stroke, point));
+            return stroke;
+        }
 
-            function getPosition(e) {
-                if (e.touches) {
-                    return { x: e.touches[0].clientX, y: e.touches[0].clientY };
+        function growStroke(stroke, [x, y]) {
+            stroke.minX = Math.min(stroke.minX, x);
+            stroke.minY = Math.min(stroke.minY, y);
+            stroke.maxX = Math.max(stroke.maxX, x);
+            stroke.maxY = Math.max(stroke.maxY, y);
+        }
+
+        // Returns null for a segment the stroke already has (a retransmit).
+        function recordSegment(data) {
+            let stroke = strokes.get(data.stroke);
+            if (!stroke) {
+                stroke = newStroke(data.color, data.erasing, [], 0);
+                strokes.set(data.stroke, stroke);
+            }
+            return takeSegment(stroke, data) ? stroke : null;
+        }
+
+        // Adds a segment's points in seq order, as Stroke.take in board.py:
+        // keys[i] is 2 * seq for the end of segment seq, one less for a
+        // start point, so a segment that arrives late goes back in place.
+        function takeSegment(stroke, data) {
+            const start = [data.lastX, data.lastY], end = [data.x, data.y], seq = data.seq;
+            if (!stroke.points.length) {
+                stroke.points.push(start, end);
+                growStroke(stroke, start);
+                growStroke(stroke, end);
+                if (seq) {
+                    stroke.keys = [2 * seq - 1, 2 * seq];
+                    stroke.seq = seq;
                 }
-                return { x: e.clientX, y: e.clientY };
+                return true;
             }
+            if (!seq || !stroke.keys) {
+                // Points from a viewport reply carry no seqs
+                if (seq) {
+                    if (seq <= stroke.seq) return false;
+                    stroke.seq = seq;
+                }
+                stroke.points.push(end);
+                growStroke(stroke, end);
+                if (stroke.keys) stroke.keys.push(stroke.keys[stroke.keys.length - 1]);
+                return true;
+            }
+            const keys = stroke.keys, key = 2 * seq;
+            let i = 0, hi = keys.length;
+            while (i < hi) {
+                const mid = (i + hi) >> 1;
+                if (keys[mid] < key) i = mid + 1; else hi = mid;
+            }
+            if (keys[i] === key) return false;
+            if (i === keys.length) {
+                stroke.points.push(end);
+                keys.push(key);
+            } else {
+                if (keys[i] === key + 1) {
+                    stroke.points[i] = end;
+                    keys[i] = key;
+                } else {
+                    stroke.points.splice(i, 0, end);
+                    keys.splice(i, 0, key);
+                }
+                if (i === 0) {
+                    stroke.points.unshift(start);
+                    keys.unshift(key - 1);
+                    growStroke(stroke, start);
+                }
+            }
+            growStroke(stroke, end);
+            stroke.seq = Math.max(stroke.seq, seq);
+            return true;
+        }
 
-            function startDrawing(e) {
-                e.preventDefault();
-                drawing = true;
-                lastX = lastY = null;
+        function strokeRect(stroke) {
+            const pad = 10 * view.scale + 2;
+            const [x0, y0] = toScreen(stroke.minX, stroke.minY);
+            const [x1, y1] = toScreen(stroke.maxX, stroke.maxY);
+            return { x: x0 - pad, y: y0 - pad, w: x1 - x0 + 2 * pad, h: y1 - y0 + 2 * pad };
+        }
+
+        function overlaps(a, b) {
+            return a.x < b.x + b.w && a.x + a.w > b.x && a.y < b.y + b.h && a.y + a.h > b.y;
+        }
+
+        function setPen(color, isEraser) {
+            ctx.lineWidth = Math.max(0.5, (isEraser ? 20 : 3) * view.scale);
+            ctx.strokeStyle = isEraser ? "white" : color;
+            ctx.lineCap = "round";
+            ctx.lineJoin = "round";
+        }
+
+        function drawStroke(stroke) {
+            setPen(stroke.color, stroke.erasing);
+            ctx.beginPath();
+            stroke.points.forEach(([x, y], i) => {
+                const [sx, sy] = toScreen(x, y);
+                if (i === 0) ctx.moveTo(sx, sy);
+                else ctx.lineTo(sx, sy);
+            });
+            ctx.stroke();
+        }
+
+        function drawSegment(data) {
+            setPen(data.color, data.erasing);
+            const [x0, y0] = toScreen(data.lastX, data.lastY);
+            const [x1, y1] = toScreen(data.x, data.y);
+            ctx.beginPath();
+            ctx.moveTo(x0, y0);
+            ctx.lineTo(x1, y1);
+            ctx.stroke();
+        }
+
+        // Repaint one screen rectangle from the page image and the strokes touching it.
+        function recomposite(r) {
+            ctx.save();
+            ctx.beginPath();
+            ctx.rect(r.x, r.y, r.w, r.h);
+            ctx.clip();
+            ctx.clearRect(r.x, r.y, r.w, r.h);
+            if (pageImage) {
+                const [px, py] = toScreen(pageImage.x, pageImage.y);
+                ctx.drawImage(pageImage.img, px, py, pageImage.img.width * view.scale, pageImage.img.height * view.scale);
             }
+            strokes.forEach(stroke => {
+                if (!stroke.hidden && overlaps(strokeRect(stroke), r)) drawStroke(stroke);
+            });
+            mathResults.forEach(drawResult);
+            ctx.restore();
+        }
 
-            function stopDrawing() {
-                drawing = false;
-                lastX = lastY = null;
+        // Answers to handwritten expressions, written after each one
+        const mathResults = new Map();  // region key: display_result
+
+        function drawResult(data) {
+            const [x0, y0, x1, y1] = data.region;
+            const [sx0, sy0] = toScreen(x0, y0);
+            const [sx1, sy1] = toScreen(x1, y1);
+            const size = Math.max(10, (sy1 - sy0) * 0.8);
+            const text = data.result !== null ? `${data.expression.endsWith("=") ? "" : "= "}${data.result}` : "?";
+            ctx.font = `${size}px Arial`;
+            ctx.fillStyle = data.result !== null ? "#0a7" : "#c33";
+            ctx.textBaseline = "middle";
+            ctx.fillText(text, sx1 + size * 0.3, (sy0 + sy1) / 2);
+        }
+
+        function redraw() {
+            recomposite({ x: 0, y: 0, w: canvas.width, h: canvas.height });
+        }
+
+        let redrawPending = false;
+        function scheduleRedraw() {
+            if (redrawPending) return;
+            redrawPending = true;
+            requestAnimationFrame(() => {
+                redrawPending = false;
+                redraw();
+            });
+        }
+
+        // Ask the server for the strokes in view, simplified for the zoom.
+        let viewportTimer = null;
+        function requestViewport() {
+            clearTimeout(viewportTimer);
+            viewportTimer = setTimeout(() => {
+                socket.emit("viewport", { ...visibleRect(), scale: view.scale });
+            }, 100);
+        }
+
+        function panBy(dx, dy) {
+            view.x -= dx / (view.scale * BOARD_UNIT);
+            view.y -= dy / (view.scale * BOARD_UNIT);
+            scheduleRedraw();
+            requestViewport();
+        }
+
+        function zoomAt(sx, sy, factor) {
+            const [bx, by] = toBoard(sx, sy);
+            view.scale = Math.min(MAX_SCALE, Math.max(MIN_SCALE, view.scale * factor));
+            view.x = bx - sx / (view.scale * BOARD_UNIT);
+            view.y = by - sy / (view.scale * BOARD_UNIT);
+            scheduleRedraw();
+            requestViewport();
+        }
+
+        function setHidden(id, hidden) {
+            const stroke = strokes.get(id);
+            if (!stroke || stroke.hidden === hidden) return;
+            stroke.hidden = hidden;
+            recomposite(strokeRect(stroke));
+        }
+
+        function resizeCanvas() {
+            canvas.width = window.innerWidth;
+            canvas.height = window.innerHeight;
+            redraw();
+        }
+        resizeCanvas();
+        window.addEventListener("resize", () => {
+            resizeCanvas();
+            requestViewport();
+        });
+
+        let drawing = false;
+        let lastX = null, lastY = null;
+        let currentStroke = null;
+        let dragFrom = null;
+        let pinch = null;
+
+        function getPosition(e) {
+            if (e.touches) {
+                return { x: e.touches[0].clientX, y: e.touches[0].clientY };
             }
+            return { x: e.clientX, y: e.clientY };
+        }
 
-            function draw(e) {
-                if (!drawing) return;
-                e.preventDefault();
+        function touchPair(e) {
+            const [a, b] = e.touches;
+            return {
+                x: (a.clientX + b.clientX) / 2,
+                y: (a.clientY + b.clientY) / 2,
+                dist: Math.hypot(a.clientX - b.clientX, a.clientY - b.clientY)
+            };
+        }
 
-                let { x, y } = getPosition(e);
+        function startDrawing(e) {
+            e.preventDefault();
+            if (e.touches && e.touches.length === 2) {
+                drawing = false;
+                pinch = touchPair(e);
+                return;
+            }
+            if (panning || e.button === 1) {
+                dragFrom = getPosition(e);
+                return;
+            }
+            drawing = true;
+            lastX = lastY = null;
+            currentStroke = newStrokeId();
+        }
 
-                ctx.lineWidth = erasing ? 20 : 3;
-                ctx.strokeStyle = erasing ? "white" : penColor;
+        function stopDrawing() {
+            drawing = false;
+            lastX = lastY = null;
+            dragFrom = null;
+            pinch = null;
+        }
 
-                if (lastX !== null && lastY !== null) {
-                    ctx.beginPath();
-                    ctx.moveTo(lastX, lastY);
-                    ctx.lineTo(x, y);
-                    ctx.stroke();
+        function draw(e) {
+            e.preventDefault();
+            if (pinch && e.touches && e.touches.length === 2) {
+                const next = touchPair(e);
+                panBy(next.x - pinch.x, next.y - pinch.y);
+                if (pinch.dist > 0) zoomAt(next.x, next.y, next.dist / pinch.dist);
+                pinch = next;
+                return;
+            }
+            if (dragFrom) {
+                const pos = getPosition(e);
+                panBy(pos.x - dragFrom.x, pos.y - dragFrom.y);
+                dragFrom = pos;
+                return;
+            }
+            if (!drawing) return;
+
+            const pos = getPosition(e);
+            let [x, y] = toBoard(pos.x, pos.y);
+            x = quantize(x);
+            y = quantize(y);
+
+            if (lastX !== null && lastY !== null) {
+                const segment = {
+                    lastX,
+                    lastY,
+                    x,
+                    y,
+                    erasing,
+                    color: penColor,
+                    stroke: currentStroke,
+                    seq: ++seq
+                };
+                recordSegment(segment);
+                drawSegment(segment);
+                sendSegment(segment);
+            }
 
-                    socket.emit("draw", {
-                        lastX: lastX / canvas.width,
-                        lastY: lastY / canvas.height,
-                        x: x / canvas.width,
-                        y: y / canvas.height,
-                        erasing,
-                        color: penColor
-                    });
-                }
+            lastX = x;
+            lastY = y;
+        }
 
-                lastX = x;
-                lastY = y;
+        canvas.addEventListener("mousedown", startDrawing);
+        canvas.addEventListener("mouseup", stopDrawing);
+        canvas.addEventListener("mousemove", draw);
+        canvas.addEventListener("touchstart", startDrawing);
+        canvas.addEventListener("touchend", stopDrawing);
+        canvas.addEventListener("touchmove", draw);
+        canvas.addEventListener("wheel", (e) => {
+            e.preventDefault();
+            if (e.ctrlKey) {
+                // Pinch on a trackpad arrives as ctrl+wheel
+                zoomAt(e.clientX, e.clientY, Math.exp(-e.deltaY * 0.01));
+            } else {
+                panBy(-e.deltaX, -e.deltaY);
             }
+        }, { passive: false });
+
+        socket.on("draw", (data) => {
+            const stroke = recordSegment(data);
+            if (stroke && !stroke.hidden) drawSegment(data);
+        });
 
-            socket.on("draw", (data) => {
-                ctx.lineWidth = data.erasing ? 20 : 3;
-                ctx.strokeStyle = data.erasing ? "white" : data.color;
-                ctx.beginPath();
-                ctx.moveTo(data.lastX * canvas.width, data.lastY * canvas.height);
-                ctx.lineTo(data.x * canvas.width, data.y * canvas.height);
-                ctx.stroke();
+        // Strokes in the requested viewport. A coarser copy never replaces
+        // detail this client already has.
+        socket.on("strokes", (data) => {
+            data.strokes.forEach(s => {
+                const existing = strokes.get(s.stroke);
+                if (existing && (existing.lod < s.lod ||
+                        (existing.lod === s.lod && existing.points.length >= s.points.length))) return;
+                const stroke = newStroke(s.color, s.erasing, s.points, s.lod, Math.max(s.seq || 0, existing ? existing.seq : 0));
+                if (existing) stroke.hidden = existing.hidden;
+                strokes.set(s.stroke, stroke);
             });
+            scheduleRedraw();
+        });
 
-            canvas.addEventListener("mousedown", startDrawing);
-            canvas.addEventListener("mouseup", stopDrawing);
-            canvas.addEventListener("mousemove", draw);
-            canvas.addEventListener("touchstart", startDrawing);
-            canvas.addEventListener("touchend", stopDrawing);
-            canvas.addEventListener("touchmove", draw);
+        socket.on("display_result", (data) => {
+            if (!data.region) {
+                if (data.error) alert("Solve failed: " + data.error);
+                return;
+            }
+            mathResults.set(data.key, data);
+            scheduleRedraw();
+        });
 
-            canvasList.push(canvas);
-        }
+        socket.on("hide_stroke", (data) => setHidden(data.stroke, true));
+        socket.on("restore_stroke", (data) => setHidden(data.stroke, false));
 
-        createCanvas(false);
+        socket.on("connect", () => {
+            // Anything lost in the drop goes again, in order
+            [...unacked.values()].forEach(segment => socket.emit("draw", segment, () => unacked.delete(segment.seq)));
+            socket.emit("viewport", { ...visibleRect(), scale: view.scale });
+        });
 
         eraserBtn.addEventListener("click", () => {
             erasing = !erasing;
@@ -212,8 +806,47 @@ html_template = """
             eraserBtn.style.background = erasing ? "red" : "gray";
         });
 
+        panBtn.addEventListener("click", () => {
+            panning = !panning;
+            panBtn.textContent = panning ? "Pan ON" : "Pan OFF";
+            panBtn.style.background = panning ? "red" : "gray";
+        });
+
+        // A new canvas is empty board space to the right of what is known
         addCanvasBtn.addEventListener("click", () => {
-            createCanvas(true);
+            let right = visibleRect().x1;
+            strokes.forEach(stroke => {
+                if (!stroke.hidden) right = Math.max(right, stroke.maxX);
+            });
+            view.x = right + 0.05;
+            scheduleRedraw();
+            requestViewport();
+        });
+
+        undoBtn.addEventListener("click", () => socket.emit("undo"));
+        redoBtn.addEventListener("click", () => socket.emit("redo"));
+
+        solveBtn.addEventListener("click", () => {
+            // Answers for what is on screen now replace any shown here before
+            const rect = visibleRect();
+            mathResults.forEach((data, key) => {
+                const [x0, y0, x1, y1] = data.region;
+                if (x0 < rect.x1 && x1 > rect.x0 && y0 < rect.y1 && y1 > rect.y0) mathResults.delete(key);
+            });
+            scheduleRedraw();
+            socket.emit("solve_math", rect);
+        });
+
+        document.addEventListener("keydown", (e) => {
+            if (!(e.ctrlKey || e.metaKey) || e.target === loadPageInput) return;
+            const key = e.key.toLowerCase();
+            if (key === "z" && !e.shiftKey) {
+                e.preventDefault();
+                socket.emit("undo");
+            } else if (key === "y" || (key === "z" && e.shiftKey)) {
+                e.preventDefault();
+                socket.emit("redo");
+            }
         });
 
         toggleMenuBtn.addEventListener("click", () => {
@@ -229,36 +862,128 @@ html_template = """
             });
         });
 
-        saveCanvasBtn.addEventListener("click", () => {
-            const canvas = canvasList[0];
-            const data = canvas.toDataURL();
-            fetch("/save", {
+        // Pages above this size go through the resumable upload API in
+        // UPLOAD_CHUNK pieces, so a dropped connection only resends one chunk.
+        const RESUMABLE_THRESHOLD = 1024 * 1024;
+        const UPLOAD_CHUNK = 256 * 1024;
+
+        function sleep(ms) {
+            return new Promise(resolve => setTimeout(resolve, ms));
+        }
+
+        async function uploadOffset(uploadId) {
+            const res = await fetch(`/upload/${uploadId}`);
+            return (await res.json()).offset;
+        }
+
+        async function uploadResumable(blob) {
+            const created = await (await fetch("/upload", { method: "POST" })).json();
+            const uploadId = created.upload_id;
+            let offset = 0;
+            let retries = 0;
+            while (offset < blob.size) {
+                try {
+                    const res = await fetch(`/upload/${uploadId}`, {
+                        method: "PATCH",
+                        headers: { 'Content-Type': 'application/octet-stream', 'Upload-Offset': String(offset) },
+                        body: blob.slice(offset, offset + UPLOAD_CHUNK)
+                    });
+                    const body = await res.json();
+                    if (res.status === 413) return body;  // retrying cannot help
+                    if (!res.ok && res.status !== 409) throw new Error(body.error);
+                    offset = body.offset;
+                    retries = 0;
+                } catch (err) {
+                    if (++retries > 5) throw err;
+                    await sleep(500 * 2 ** retries);
+                    offset = await uploadOffset(uploadId);
+                }
+            }
+            const res = await fetch(`/upload/${uploadId}/finish`, {
                 method: "POST",
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ data })
-            }).then(res => res.json()).then(res => alert("Saved with page ID: " + res.page_id));
+                headers: { 'Content-Type': blob.type }
+            });
+            return res.json();
+        }
+
+        async function uploadPage(blob) {
+            if (blob.size > RESUMABLE_THRESHOLD) {
+                return uploadResumable(blob);
+            }
+            const res = await fetch("/save", {
+                method: "POST",
+                headers: { 'Content-Type': blob.type },
+                body: blob
+            });
+            return res.json();
+        }
+
+        saveCanvasBtn.addEventListener("click", () => {
+            canvas.toBlob(blob => {
+                uploadPage(blob).then(res => alert(res.page_id ? "Saved with page ID: " + res.page_id : "Save failed: " + res.error));
+            }, "image/png");
         });
 
+        function loadPage(id) {
+            const img = new Image();
+            img.onload = () => {
+                // The page goes under the board strokes, at the top-left of the view
+                pageImage = { img, x: view.x, y: view.y };
+                redraw();
+            };
+            img.onerror = () => alert("Page not found");
+            img.src = `/page/${encodeURIComponent(id)}`;
+        }
+
         loadPageBtn.addEventListener("click", () => {
-            const id = loadPageInput.value;
-            fetch(`/load/${id}`).then(res => res.json()).then(res => {
-                const img = new Image();
-                img.onload = () => {
-                    const ctx = canvasList[0].getContext("2d");
-                    ctx.clearRect(0, 0, canvasList[0].width, canvasList[0].height);
-                    ctx.drawImage(img, 0, 0);
-                };
-                img.src = res.data;
+            loadPage(loadPageInput.value);
+        });
+
+        // The gallery only fetches the page index and small thumbnails; the
+        // full page body is requested when a tile is clicked.
+        function addPageTile(page) {
+            const tile = document.createElement("div");
+            tile.className = "page-tile";
+            const label = document.createElement("div");
+            label.textContent = `${page.id} · ${new Date(page.created * 1000).toLocaleString()}`;
+            if (page.thumbnail) {
+                const img = document.createElement("img");
+                img.loading = "lazy";
+                img.src = `/thumb/${page.id}`;
+                tile.appendChild(img);
+            }
+            tile.appendChild(label);
+            tile.addEventListener("click", () => {
+                pageGallery.style.display = "none";
+                loadPage(page.id);
             });
+            pageTiles.appendChild(tile);
+        }
+
+        function loadPageListing() {
+            fetch(`/pages?offset=${nextPageOffset}&limit=50`).then(res => res.json()).then(res => {
+                res.pages.forEach(addPageTile);
+                nextPageOffset = res.next;
+                morePagesBtn.style.display = res.next === null ? "none" : "block";
+            });
+        }
+
+        myPagesBtn.addEventListener("click", () => {
+            if (pageGallery.style.display === "block") {
+                pageGallery.style.display = "none";
+                return;
+            }
+            pageTiles.innerHTML = "";
+            nextPageOffset = 0;
+            pageGallery.style.display = "block";
+            loadPageListing();
         });
 
+        morePagesBtn.addEventListener("click", loadPageListing);
+
         logoutBtn.addEventListener("click", () => {
             fetch("/logout").then(() => location.reload());
         });
-
-        socket.on("add_canvas", () => {
-            createCanvas(false);
-        });
     </script>
 </body>
 </html>
@@ -467,22 +1192,32 @@ auth_template = """
 </html>
 """
 
+compiled_templates = {}  # template source: jinja Template
+
+
+def compiled(source):
+    """The template for ``source``, compiled on first use instead of per request."""
+    template = compiled_templates.get(source)
+    if template is None:
+        template = compiled_templates[source] = app.jinja_env.from_string(source)
+    return template
+
 @app.route('/')
 def index():
     if 'username' not in session:
         return redirect('/login')
-    return render_template_string(html_template)
+    return render_template(compiled(html_template), socket_options=transport["client"])
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if username in users and users[username] == password:
+        if username in users and check_password_hash(users[username], password):
             session['username'] = username
             return redirect('/')
-        return render_template_string(auth_template)
-    return render_template_string(auth_template)
+        return render_template(compiled(auth_template))
+    return render_template(compiled(auth_template))
 
 
 @app.route('/signup', methods=['GET', 'POST'])
@@ -490,13 +1225,16 @@ def signup():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if username in users:
-            return render_template_string(auth_template)
-        users[username] = password
-        user_drawings[username] = {}
+        with state_lock:
+            if username in users:
+                return render_template(compiled(auth_template))
+            users[username] = generate_password_hash(password)
+            user_drawings[username] = PageIndex()
+            ticket = journal(["user", username, users[username]])
+        wait_durable(ticket)
         session['username'] = username
         return redirect('/')
-    return render_template_string(auth_template)
+    return render_template(compiled(auth_template))
 
 
 @app.route('/logout')
@@ -508,30 +1246,247 @@ def logout():
 def save():
     if 'username' not in session:
         return jsonify({"error": "Unauthorized"}), 401
-    data = request.json['data']
-    page_id = str(uuid.uuid4())[:8]
-    user_drawings[session['username']][page_id] = data
+    username = session['username']
+    try:
+        if request.is_json:
+            # Legacy clients post {"data": "data:image/png;base64,..."}
+            page_id, meta = store.save_data_url(username, request.json['data'])
+        else:
+            # Raw image/png or application/x-ndjson body, streamed to disk
+            page_id, meta = store.save_stream(username, request.stream, mimetype_kinds.get(request.mimetype))
+    except PageTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except InvalidPage as e:
+        return jsonify({"error": str(e)}), 400
+    add_page(username, page_id, meta)
+    return jsonify({"page_id": page_id})
+
+@app.route('/upload', methods=['POST'])
+def create_upload():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"upload_id": store.create_upload(session['username'])})
+
+@app.route('/upload/<upload_id>', methods=['GET', 'PATCH'])
+def upload(upload_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session['username']
+    try:
+        if request.method == 'PATCH':
+            offset = int(request.headers.get('Upload-Offset', ''))
+            offset = store.append_upload(username, upload_id, offset, request.stream)
+        else:
+            offset = store.upload_offset(username, upload_id)
+    except (KeyError, FileNotFoundError):
+        return jsonify({"error": "Upload not found"}), 404
+    except UploadConflict as e:
+        return jsonify({"error": "Offset mismatch", "offset": e.offset}), 409
+    except PageTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError:
+        return jsonify({"error": "Missing Upload-Offset"}), 400
+    return jsonify({"offset": offset})
+
+@app.route('/upload/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session['username']
+    try:
+        page_id, meta = store.finish_upload(username, upload_id, mimetype_kinds.get(request.mimetype))
+    except (KeyError, FileNotFoundError):
+        return jsonify({"error": "Upload not found"}), 404
+    except InvalidPage as e:
+        return jsonify({"error": str(e)}), 400
+    add_page(username, page_id, meta)
     return jsonify({"page_id": page_id})
 
 @app.route('/load/<page_id>')
 def load(page_id):
     if 'username' not in session:
         return jsonify({"error": "Unauthorized"}), 401
-    drawings = user_drawings.get(session['username'], {})
-    if page_id in drawings:
-        return jsonify({"data": drawings[page_id]})
-    return jsonify({"error": "Page not found"}), 404
+    username = session['username']
+    meta = user_drawings.get(username, {}).get(page_id)
+    if meta is None:
+        return jsonify({"error": "Page not found"}), 404
+    with store.open_page(username, page_id, meta["kind"]) as f:
+        if meta["kind"] == "strokes":
+            return jsonify({"strokes": [json.loads(line) for line in f if line.strip()]})
+        return jsonify({"data": "data:image/png;base64," + base64.b64encode(f.read()).decode()})
+
+@app.route('/pages')
+def list_pages():
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    index = user_drawings.get(session['username'], PageIndex())
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(200, max(1, request.args.get('limit', 50, type=int)))
+    listing = index.listing(offset, limit)
+    next_offset = offset + limit if offset + limit < len(index) else None
+    return jsonify({"pages": listing, "total": len(index), "next": next_offset})
+
+@app.route('/thumb/<page_id>')
+def thumbnail(page_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session['username']
+    meta = user_drawings.get(username, PageIndex()).get(page_id)
+    if meta is None or not meta["thumbnail"]:
+        return jsonify({"error": "Thumbnail not found"}), 404
+    return send_file(store.thumbnail_path(username, page_id), mimetype="image/png", max_age=86400)
+
+@app.route('/render/<page_id>.<fmt>')
+def render_page(page_id, fmt):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session['username']
+    meta = user_drawings.get(username, PageIndex()).get(page_id)
+    if meta is None:
+        return jsonify({"error": "Page not found"}), 404
+    if meta["kind"] != "strokes" or fmt not in render_formats:
+        return jsonify({"error": "Only stroke pages can be rendered, as png, svg or pdf"}), 400
+    width, height = snap_size(request.args.get('width', 1920, type=int), request.args.get('height', 1080, type=int))
+    path = store.render_path(meta["sha256"], fmt, width, height)
+    if not os.path.exists(path):
+        future = submit_render(store.page_path(username, page_id, "strokes"), path, fmt, width, height)
+        # Cooperative wait, so eventlet/gevent keep serving other clients
+        while not future.done():
+            socketio.sleep(0.01)
+        future.result()
+    return send_file(path, mimetype=render_formats[fmt], max_age=86400)
+
+@app.route('/page/<page_id>')
+def page(page_id):
+    if 'username' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session['username']
+    meta = user_drawings.get(username, {}).get(page_id)
+    if meta is None:
+        return jsonify({"error": "Page not found"}), 404
+    return send_file(store.page_path(username, page_id, meta["kind"]), mimetype=kinds[meta["kind"]]["mimetype"])
+
+def author_id():
+    return session.get('username') or request.sid
+
+def relay_draw(sid, author, segment):
+    stroke = board.add_segment(author, segment)
+    if stroke is None:
+        return  # a retransmit of a segment we already relayed
+    segment['stroke'] = stroke.id
+    segment['author'] = stroke.author
+    if ring is not None:
+        ring.write(segment, stroke.author)
+    # The sender has already drawn the segment locally
+    socketio.emit('draw', segment, to=DRAW_ROOM, skip_sid=sid)
+
+def flush_coalesced():
+    """Relay held segments as their senders' buckets refill."""
+    while True:
+        socketio.sleep(COALESCE_INTERVAL)
+        for sid, author, username in coalescer.senders():
+            while draw_limiter.allow(sid, username):
+                segment = coalescer.pop(sid)
+                if segment is None:
+                    break
+                relay_draw(sid, author, segment)
 
 @socketio.on('draw')
 def handle_draw(data):
-    emit('draw', data, broadcast=True)
-
-@socketio.on('add_canvas')
-def handle_add_canvas():
-    emit('add_canvas', broadcast=True)
+    segment = clean_segment(data)
+    if segment is None:
+        return
+    username = session.get('username')
+    if draw_limiter.allow(request.sid, username):
+        if overflow_policy == "coalesce":
+            segment = coalescer.merge(request.sid, segment)
+        relay_draw(request.sid, author_id(), segment)
+    elif overflow_policy == "coalesce":
+        coalescer.hold(request.sid, author_id(), username, segment)
+    elif overflow_policy == "disconnect":
+        disconnect()
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    join_room(DRAW_ROOM)
+
+@socketio.on('use_ring')
+def handle_use_ring():
+    """The viewer reads draws from the shared-memory ring; stop sending them here."""
+    if ring is not None:
+        leave_room(DRAW_ROOM)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    draw_limiter.forget(request.sid)
+    coalescer.forget(request.sid)
+
+@socketio.on('viewport')
+def handle_viewport(data):
+    try:
+        rect = tuple(float(data[key]) for key in ('x0', 'y0', 'x1', 'y1'))
+        scale = float(data.get('scale', 1))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return
+    if not (scale > 0 and math.isfinite(scale) and all(math.isfinite(v) for v in rect)):
+        return
+    emit('strokes', {"strokes": board.viewport(rect, scale)})
+
+@socketio.on('undo')
+def handle_undo():
+    stroke = board.undo(author_id())
+    if stroke is not None:
+        emit('hide_stroke', {"stroke": stroke.id}, broadcast=True)
+
+@socketio.on('redo')
+def handle_redo():
+    stroke = board.redo(author_id())
+    if stroke is not None:
+        emit('restore_stroke', {"stroke": stroke.id}, broadcast=True)
+
+@socketio.on('solve_math')
+def handle_solve_math(data):
+    """Recognize and evaluate the handwritten expressions in a board area."""
+    if isinstance(data, dict) and isinstance(data.get('expression'), str):
+        # A typed expression, as the old math page sent
+        try:
+            emit('display_result', {"expression": data['expression'], "result": evaluate(data['expression'])})
+        except ValueError as e:
+            emit('display_result', {"expression": data['expression'], "result": None, "error": str(e)})
+        return
+    try:
+        rect = tuple(float(data[key]) for key in ('x0', 'y0', 'x1', 'y1'))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return
+    if not all(math.isfinite(v) for v in rect):
+        return
+    strokes = board.strokes_in(rect)
+    if too_much_ink(strokes):
+        # Grouping and hashing run here on the relay; keep them small.
+        emit('display_result', {"expression": None, "result": None, "error": "too much ink; zoom in"})
+        return
+    for region in group_regions(strokes):
+        symbols = split_symbols(region)
+        bounds = region_rect(region)
+        key = content_key(symbols, bounds)
+        with math_lock:
+            text = math_results.get(key)
+            if text is None:
+                if key in math_waiting:
+                    math_waiting[key].append((request.sid, bounds))
+                else:
+                    math_waiting[key] = [(request.sid, bounds)]
+                    math_queue.append((key, symbols))
+                continue
+        send_result(request.sid, bounds, key, text)
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5000)
+    open_wal()
+    open_ring()
+    if overflow_policy == "coalesce":
+        socketio.start_background_task(flush_coalesced)
+    socketio.start_background_task(math_batcher)
+    socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PAD_PORT", 5000)))
 
 
 
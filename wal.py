@@ -0,0 +1,206 @@
+"""Write-ahead log for the relay's in-memory state.
+
+Records are JSON lines appended to numbered segment files. Appends only
+queue the record; a flusher thread writes and fsyncs whatever has queued
+every ``flush_interval`` seconds or as soon as ``batch_size`` records are
+waiting (group commit), so durability costs one fsync per batch rather
+than per stroke segment. Callers that must not answer before a record is
+on disk (saves, signups) pass the ticket from ``append`` to ``wait``.
+
+A checkpoint switches appends to a new segment, writes a snapshot of the
+state as of that switch, then deletes the segments the snapshot covers.
+Recovery loads the newest snapshot and replays the segments after it.
+"""
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+segment_pattern = re.compile(r"wal-(\d+)\.log$")
+snapshot_pattern = re.compile(r"snapshot-(\d+)\.json$")
+encoder = json.JSONEncoder(separators=(",", ":"))
+
+
+def numbered(directory, pattern):
+    found = []
+    for path in glob.glob(os.path.join(directory, "*")):
+        match = pattern.search(os.path.basename(path))
+        if match:
+            found.append((int(match.group(1)), path))
+    return sorted(found)
+
+
+def fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_records(path):
+    """Records in one segment; a torn final line from a crash is skipped."""
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            yield json.loads(line)
+
+
+class WriteAheadLog:
+    def __init__(self, directory, flush_interval=0.01, batch_size=1024):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        os.makedirs(directory, exist_ok=True)
+        segments = numbered(directory, segment_pattern)
+        snapshots = numbered(directory, snapshot_pattern)
+        self.segment = max([n for n, _ in segments] + [n for n, _ in snapshots] + [0]) + 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.bytes_written = 0
+        self.pending = []
+        self.appended = 0  # records queued so far
+        self.durable = 0  # records known to be on disk
+        self.sync_requested = False
+        self.closed = False
+        # cond guards the queue; write_lock serializes file writes and
+        # rotation, so appends never wait for an fsync.
+        self.cond = threading.Condition()
+        self.write_lock = threading.RLock()
+        self.flusher = threading.Thread(target=self.flush_loop, name="wal-flusher", daemon=True)
+        self.flusher.start()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "wal-%08d.log" % number)
+
+    def snapshot_path(self, number):
+        return os.path.join(self.directory, "snapshot-%08d.json" % number)
+
+    def append(self, record):
+        """Queue a record; returns a ticket to pass to ``wait``."""
+        line = encoder.encode(record).encode() + b"\n"
+        with self.cond:
+            self.pending.append(line)
+            self.appended += 1
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify_all()
+            return self.appended
+
+    def wait(self, ticket):
+        """Block until the record behind ``ticket`` is on disk."""
+        with self.cond:
+            if self.durable < ticket:
+                # Write now rather than at the next tick, so a sync caller
+                # waits for one fsync at most.
+                self.sync_requested = True
+                self.cond.notify_all()
+                self.cond.wait_for(lambda: self.durable >= ticket or self.closed)
+
+    def write_pending(self):
+        """Write and fsync everything queued so far."""
+        with self.write_lock:
+            with self.cond:
+                batch, self.pending = self.pending, []
+                count = self.appended
+                self.sync_requested = False
+            if batch:
+                data = b"".join(batch)
+                self.file.write(data)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.bytes_written += len(data)
+            with self.cond:
+                self.durable = max(self.durable, count)
+                self.cond.notify_all()
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.pending) >= self.batch_size or self.sync_requested
+                                   or self.closed, timeout=self.flush_interval)
+                if self.closed:
+                    return
+            self.write_pending()
+
+    def recover(self, restore, apply):
+        """Rebuild state: ``restore(snapshot)`` then ``apply(record)`` for each later record.
+
+        Returns the number of records replayed.
+        """
+        return replay(self.directory, restore, apply, before=self.segment)
+
+    def rotate(self):
+        """Start a new segment; returns its number.
+
+        The caller must hold whatever lock orders state changes against
+        their log records, so the state captured under that same lock
+        matches exactly the records in the earlier segments.
+        """
+        with self.write_lock:
+            self.write_pending()
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), "ab")
+            self.bytes_written = 0
+            fsync_dir(self.directory)
+            return self.segment
+
+    def write_snapshot(self, number, state):
+        """Persist the state as of segment ``number`` and drop what it covers."""
+        path = self.snapshot_path(number)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        fsync_dir(self.directory)
+        for old, old_path in numbered(self.directory, segment_pattern):
+            if old < number:
+                os.remove(old_path)
+        for old, old_path in numbered(self.directory, snapshot_pattern):
+            if old < number:
+                os.remove(old_path)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.flusher.join()
+        self.write_pending()
+        self.file.close()
+
+
+def replay(directory, restore, apply, before=None):
+    """Feed a log directory's newest snapshot and later records to
+    ``restore`` and ``apply`` without writing anything; ``before`` stops at
+    that segment. Returns the number of records replayed."""
+    snapshots = numbered(directory, snapshot_pattern)
+    start = 0
+    if snapshots:
+        start, path = snapshots[-1]
+        with open(path) as f:
+            restore(json.load(f))
+    replayed = 0
+    for number, path in numbered(directory, segment_pattern):
+        if start <= number and (before is None or number < before):
+            for record in read_records(path):
+                apply(record)
+                replayed += 1
+    return replayed
+
+
+def checkpoint_loop(wal, lock, capture, interval, max_bytes, sleep=time.sleep):
+    """Checkpoint every ``interval`` seconds, or sooner once the live segment passes ``max_bytes``."""
+    last = time.monotonic()
+    while not wal.closed:
+        sleep(1)
+        if wal.bytes_written < max_bytes and time.monotonic() - last < interval:
+            continue
+        with lock:
+            number = wal.rotate()
+            state = capture()
+        wal.write_snapshot(number, state)
+        last = time.monotonic()